@@ -0,0 +1,43 @@
+# Compares the gridding backends of rsm_convert on the bundled scans S014 and S021.
+# The scans are loaded and converted once, only the binning into the h,k,l grid is timed.
+# usage: python benchmarks/bench_gridder.py
+
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import pyRSM
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'data')
+
+def main(scans = [14, 21], sizes = [50, 100, 200], repeat = 3):
+    stacks = [pyRSM.load_convert(DATA, scan) for scan in scans]
+    imgs, qx, qy, qz = [np.concatenate([stack[i] for stack in stacks]) for i in range(4)]
+    flag = imgs > 0
+    points = [qx[flag], qy[flag], qz[flag], imgs[flag]]
+    hklrange = [[np.min(qx), np.max(qx)], [np.min(qy), np.max(qy)], [np.min(qz), np.max(qz)]]
+    print(str(flag.sum()) + ' pixels from scans ' + str(scans))
+
+    backends = [('xu', np.float64), ('numpy', np.float64), ('numpy', np.float32)]
+    print('{:>6} {:>8} {:>8} {:>10} {:>10}'.format('grid', 'backend', 'dtype', 'time (s)', 'max diff'))
+    for n in sizes:
+        reference = None
+        for gridder, dtype in backends:
+            times = []
+            for _ in range(repeat):
+                g = pyRSM.make_gridder(gridder, n, n, n, hklrange, dtype)
+                t0 = time.perf_counter()
+                g(*points)
+                times.append(time.perf_counter() - t0)
+            grid_sum, grid_count = pyRSM.gridder_sums(g)
+            data = np.where(grid_count > 0, grid_sum / np.maximum(grid_count, 1), 0)
+            if reference is None:
+                reference = data
+            print('{:>6} {:>8} {:>8} {:>10.3f} {:>10.2e}'.format(
+                n, gridder, np.dtype(dtype).name, min(times), np.max(np.abs(data - reference))))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,34 @@
+# Checks the NumPy QEngine against hxrd.Ang2Q.area on the bundled scans S014 and S021
+# and compares the conversion times.
+# usage: python benchmarks/bench_qengine.py
+
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import pyRSM
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'data')
+
+def timed(func):
+    t0 = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - t0
+
+def main(scans = [14, 21]):
+    print('{:>5} {:>8} {:>8} {:>10} {:>12}'.format('scan', 'backend', 'dtype', 'time (s)', 'max |dhkl|'))
+    for scan in scans:
+        info = pyRSM.load_scan(DATA, scan)
+        reference, t = timed(lambda: pyRSM.hkl_converter(info, 'xu')(slice(None)))
+        print('{:>5} {:>8} {:>8} {:>10.3f} {:>12}'.format(scan, 'xu', 'float64', t, '-'))
+        for dtype in [np.float64, np.float32]:
+            pyRSM.get_qengine(dtype)
+            hkl, t = timed(lambda: pyRSM.hkl_converter(info, 'numpy', dtype)(slice(None)))
+            diff = max(np.max(np.abs(a - b)) for a, b in zip(hkl, reference))
+            print('{:>5} {:>8} {:>8} {:>10.3f} {:>12.2e}'.format(scan, 'numpy', np.dtype(dtype).name, t, diff))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+# Benchmark suite of the whole pipeline on synthetic data of configurable size (see synthetic.py).
+# Times load_convert, rsm_convert for every gridding backend and grid size, visualize_det, the slice
+# viewers and save_vtk/load_vtk, traces the peak memory of every step with tracemalloc and writes the
+# results as JSON, so that runs on different versions or machines can be compared.
+# usage: python benchmarks/bench_suite.py [--scans 2] [--frames 60] [--size 516] [--sparsity 0.05]
+#                                         [--grids 50 100] [--repeat 1] [--output results.json]
+#                                         [--compare old_results.json]
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import plotly.io as pio
+import xrayutilities as xu
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import pyRSM
+from synthetic import make_dataset
+
+def measure(func, repeat = 1):
+    # The best wall time of repeat calls, and the peak memory allocated during one more call traced
+    # by tracemalloc (NumPy arrays included), which is kept apart as tracing slows Python code down.
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return min(times), peak
+
+def run(file_name, scan_list, detector, grids = [50, 100], repeat = 1):
+    # the list of benchmark results {'name', 'time', 'peak_memory'} on a dataset written by make_dataset
+    results = []
+
+    def bench(name, func):
+        t, peak = measure(func, repeat)
+        results.append(dict(name = name, time = t, peak_memory = peak))
+        print('{:<40} {:>10.3f} {:>12.1f}'.format(name, t, peak / 2**20))
+
+    print('{:<40} {:>10} {:>12}'.format('benchmark', 'time (s)', 'peak (MiB)'))
+    scan = scan_list[0]
+    for converter in ['xu', 'numpy']:
+        bench('load_convert converter=' + converter,
+              lambda: pyRSM.load_convert(file_name, scan, converter = converter, detector = detector))
+    for n in grids:
+        for gridder in pyRSM.GRIDDERS:
+            bench('rsm_convert gridder=' + gridder + ' n=' + str(n),
+                  lambda: pyRSM.rsm_convert(file_name, scan_list, n, n, n, gridder = gridder, detector = detector))
+        bench('rsm_convert max_memory=256MiB n=' + str(n),
+              lambda: pyRSM.rsm_convert(file_name, scan_list, n, n, n, gridder = 'numpy', max_memory = 2**28,
+                                        detector = detector))
+
+    imgs, qx, qy, qz = pyRSM.load_convert(file_name, scan, detector = detector)
+    bench('visualize_det', lambda: pyRSM.visualize_det(imgs, qx, qy, qz))
+    grid_data, coords = pyRSM.rsm_convert(file_name, scan_list, grids[0], grids[0], grids[0],
+                                          gridder = 'numpy', detector = detector)
+    for viewer in [pyRSM.h_slice, pyRSM.k_slice, pyRSM.l_slice]:
+        bench(viewer.__name__, lambda: viewer(grid_data, coords, logscale = True))
+    bench('save_vtk', lambda: pyRSM.save_vtk(grid_data, coords, 'benchmark'))
+    vti = [os.path.join(root, name) for root, dirs, names in os.walk('.') for name in names if name.endswith('.vti')]
+    bench('load_vtk', lambda: pyRSM.load_vtk(vti[0]))
+    return results
+
+def compare(results, old_results):
+    # prints the time and peak memory of every benchmark relative to an earlier run
+    old = {result['name']: result for result in old_results}
+    print('{:<40} {:>10} {:>12}'.format('benchmark', 'time', 'peak memory'))
+    for result in results:
+        if result['name'] in old:
+            print('{:<40} {:>9.2f}x {:>11.2f}x'.format(
+                result['name'], result['time'] / old[result['name']]['time'],
+                result['peak_memory'] / max(old[result['name']]['peak_memory'], 1)))
+
+def main():
+    parser = argparse.ArgumentParser(description = 'pyRSM benchmark suite on synthetic data')
+    parser.add_argument('--scans', type = int, default = 2, help = 'number of scans')
+    parser.add_argument('--frames', type = int, default = 60, help = 'frames per scan')
+    parser.add_argument('--size', type = int, default = 516, help = 'detector size in pixels')
+    parser.add_argument('--sparsity', type = float, default = 0.05, help = 'fraction of non-zero background pixels')
+    parser.add_argument('--grids', type = int, nargs = '+', default = [50, 100], help = 'grid sizes n (n x n x n)')
+    parser.add_argument('--repeat', type = int, default = 1, help = 'timed calls per benchmark')
+    parser.add_argument('--output', default = 'benchmark_results.json', help = 'JSON file of the results')
+    parser.add_argument('--compare', help = 'JSON file of an earlier run to compare with')
+    args = parser.parse_args()
+
+    # the slice viewers call fig.show(), which must not open a browser here
+    pio.renderers.default = ''
+    output = os.path.abspath(args.output)
+    old_results = None
+    if args.compare:
+        with open(args.compare) as f:
+            old_results = json.load(f)['results']
+
+    cwd = os.getcwd()
+    path = tempfile.mkdtemp(prefix = 'pyRSM_benchmark_')
+    try:
+        t0 = time.perf_counter()
+        file_name, scan_list, detector = make_dataset(path, args.scans, args.frames, args.size, args.sparsity)
+        print('Synthetic data written in {:.1f} s to {}'.format(time.perf_counter() - t0, path))
+        # save_vtk writes into the working directory
+        os.chdir(path)
+        results = run(file_name, scan_list, detector, args.grids, args.repeat)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(path, ignore_errors = True)
+
+    report = dict(
+        config = dict(scans = args.scans, frames = args.frames, size = args.size, sparsity = args.sparsity,
+                      grids = args.grids, repeat = args.repeat),
+        environment = dict(python = platform.python_version(), platform = platform.platform(),
+                           numpy = np.__version__, xrayutilities = xu.__version__,
+                           cpus = os.cpu_count()),
+        date = time.strftime('%Y-%m-%dT%H:%M:%S'),
+        results = results)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent = 2)
+    print('Results written to ' + output)
+    if old_results is not None:
+        compare(results, old_results)
+
+if __name__ == '__main__':
+    main()
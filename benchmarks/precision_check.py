@@ -0,0 +1,67 @@
+# Accuracy of the float32 pipeline (dtype=np.float32 of load_convert and rsm_convert) against float64
+# on the bundled scans: the largest h,k,l difference in units of the voxel size, the fraction of
+# pixels that fall into another voxel, the 99.9th percentile and the largest relative difference of
+# the voxel intensities, the voxels that are empty in only one of the grids, the relative difference
+# of the summed intensity and the memory of the loaded stacks.
+# usage: python benchmarks/precision_check.py [n] [scan ...]
+
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import pyRSM
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'data')
+
+def voxel_index(stack, n, hklrange):
+    # the voxel of every pixel with intensity > 0 of a stack, -1 outside hklrange
+    g = pyRSM.make_gridder('numpy', n, n, n, hklrange)
+    flag = stack[0] > 0
+    idx, inside = g.index(*[q[flag] for q in stack[1:]])
+    voxel = np.full(np.count_nonzero(flag), -1)
+    voxel[inside] = idx
+    return voxel
+
+def compare(scan_num, n = 100, converter = 'xu', gridder = 'numpy'):
+    # float32 against float64 for one scan, as a dict of the differences
+    stack64 = pyRSM.load_convert(DATA, scan_num, converter = converter)
+    stack32 = pyRSM.load_convert(DATA, scan_num, dtype = np.float32, converter = converter)
+    grid64, coords = pyRSM.grid_stacks([stack64], n, n, n, gridder = gridder)
+    # the same grid for both, so that the voxels can be compared one to one
+    hklrange = [[c[0], c[-1]] for c in coords]
+    grid32, _ = pyRSM.grid_stacks([stack32], n, n, n, hklrange, gridder = gridder, dtype = np.float32)
+
+    voxel = [c[1] - c[0] for c in coords]
+    hkl_error = max(np.abs(q32 - q64).max() / d for q32, q64, d in zip(stack32[1:], stack64[1:], voxel))
+    moved = np.mean(voxel_index(stack64, n, hklrange) != voxel_index(stack32, n, hklrange))
+    both = ~np.isnan(grid64) & ~np.isnan(grid32)
+    error = np.abs(grid32[both] - grid64[both]) / np.abs(grid64[both])
+    return dict(
+        hkl_error = hkl_error,
+        moved = moved,
+        intensity_error = (np.percentile(error, 99.9), error.max()),
+        empty_mismatch = int(np.sum(np.isnan(grid64) != np.isnan(grid32))),
+        voxels = int(np.sum(~np.isnan(grid64))),
+        sum_error = abs(np.nansum(grid32, dtype=np.float64) / np.nansum(grid64) - 1),
+        memory = (sum(a.nbytes for a in stack32), sum(a.nbytes for a in stack64)))
+
+def main():
+    args = sys.argv[1:]
+    n = int(args[0]) if args else 100
+    scans = [int(a) for a in args[1:]] or [14, 21]
+    print('{:>5} {:>9} {:>8} {:>12} {:>9} {:>19} {:>16} {:>9} {:>13}'.format(
+        'scan', 'converter', 'gridder', 'hkl (voxel)', 'moved', 'intensity 99.9%/max', 'empty differs',
+        'sum', 'memory (MB)'))
+    for scan_num in scans:
+        for converter in ['xu', 'numpy']:
+            for gridder in ['numpy', 'xu']:
+                r = compare(scan_num, n, converter, gridder)
+                print('{:>5} {:>9} {:>8} {:>12.1e} {:>9.1e} {:>9.1e} / {:<7.1e} {:>5} of {:<7} {:>9.1e} {:>5.0f} / {:<5.0f}'
+                      .format(scan_num, converter, gridder, r['hkl_error'], r['moved'], *r['intensity_error'],
+                              r['empty_mismatch'], r['voxels'], r['sum_error'], r['memory'][0] / 1e6,
+                              r['memory'][1] / 1e6))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+# Synthetic spec files and tif stacks in the layout read by pyRSM, for benchmarks of any size.
+# The scans are eta rocking scans in the geometry of the bundled scan S014 (psic, 21 keV, the UB
+# matrix of data/data.spec) with a Gaussian Bragg peak on a sparse random background.
+# usage: python benchmarks/synthetic.py <directory> [n_scans] [frames] [size] [sparsity]
+
+import os
+import sys
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import pyRSM
+
+UB = [[1.597393919, -0.1121055355, 0.07829054776],
+      [0.1098476002, 1.598660284, 0.04957614101],
+      [-0.08013251561, -0.04327463141, 1.628635567]]
+ENERGY = 21.0001
+# Delta, Eta (start of the first scan), Chi, Phi, Nu, Mu
+ANGLES = [35.704625, 20.320625, 91.71575, -89.42275, 0., 0.]
+ETA_STEP = 0.01
+
+def synthetic_detector(size = 516):
+    # DETECTOR scaled to size x size pixels of the same total width
+    return dict(pyRSM.DETECTOR, Nch1 = size, Nch2 = size,
+                cch1 = pyRSM.DETECTOR['cch1'] * size / 516, cch2 = pyRSM.DETECTOR['cch2'] * size / 516,
+                pwidth1 = 28.38 / size, pwidth2 = 28.38 / size)
+
+def scan_header(scan_num, eta, frames):
+    # the header lines of a scan, with the energy line at the index read by load_scan
+    lines = ['#S ' + str(scan_num) + '  ascan  eta ' + str(eta[0]) + ' ' + str(eta[-1]) + '  ' + str(frames - 1) + ' 1',
+             '#D Thu Jan 01 00:00:00 2026',
+             '#T 1  (Seconds)',
+             '#G0 0 0 1 1 0 0 0 0 0 0 0 0 0 0 0 0 2 4 2 1 4 0 0',
+             '#G1 3.919225088 3.919225088 3.851714461 90 90 90 1.603170312 1.603170312 1.631269756 90 90 90'
+             ' 0 0 4 0 3 1 35.704625 20.620625 91.71575 -89.42275 0 0 27.56625 11.683375 163.0875 -89.132 0 0'
+             ' 0.5903994507 0.5903994507 0 0',
+             '#G3 ' + ' '.join(str(v) for row in UB for v in row),
+             '#G4 0 0 4 0.5903994507',
+             '#Q 0 0 4',
+             '#P0 ' + ' '.join(str(angle) for angle in [ANGLES[0], eta[0]] + ANGLES[2:])]
+    lines += ['#P' + str(i) + ' 0' for i in range(1, 10)]
+    lines += ['#UE ' + str(ENERGY) + ' 0.590399 0 0 (Energy in keV, Lambda in Angstroem, Undulator Gap + Energy)',
+              '#N 4',
+              '#L Eta  Epoch  Seconds  Ion_Ch_4']
+    return lines
+
+def frame_intensity(qx, qy, qz, peak, rng, sparsity, width = 0.01, height = 1e5):
+    # a Gaussian peak of the given hkl width plus a background with a fraction sparsity of non-zero pixels
+    r2 = (qx - peak[0])**2 + (qy - peak[1])**2 + (qz - peak[2])**2
+    intensity = height * np.exp(-r2 / (2 * width**2))
+    intensity += (rng.random(qx.shape) < sparsity) * rng.integers(1, 10, qx.shape)
+    return np.rint(intensity).astype(np.int32)
+
+def make_dataset(path, n_scans = 2, frames = 60, size = 516, sparsity = 0.05, seed = 0):
+    # Writes path/synthetic.spec with n_scans consecutive eta scans of frames points and their size x size
+    # tif frames in path/images/Sxxx/. Returns the file name for pyRSM, the scan numbers and the detector
+    # parameters of the images.
+    rng = np.random.default_rng(seed)
+    detector = synthetic_detector(size)
+    engine = pyRSM.get_qengine(np.float64, detector)
+    file_name = os.path.join(path, 'synthetic')
+    spec = ['#F synthetic', '#E 0', '#D Thu Jan 01 00:00:00 2026', '',
+            '#O0 Delta  Eta  Chi  Phi  Nu  Mu']
+    spec += ['#O' + str(i) + ' Spare' + str(i) for i in range(1, 10)]
+    spec.append('')
+
+    scan_list = list(range(1, n_scans + 1))
+    peak = None
+    for scan_num in scan_list:
+        eta = np.round(ANGLES[1] + ETA_STEP * (np.arange(frames) + (scan_num - 1) * frames), 6)
+        I0 = rng.normal(160000, 1000, frames).round()
+        spec += scan_header(scan_num, eta, frames)
+        spec += [' '.join(str(v) for v in [eta[i], float(i), 1, I0[i]]) for i in range(frames)]
+        spec.append('')
+
+        # mu, eta, chi, phi, nu, delta of every frame
+        angles = [np.full(frames, ANGLES[5]), eta, np.full(frames, ANGLES[2]), np.full(frames, ANGLES[3]),
+                  np.full(frames, ANGLES[4]), np.full(frames, ANGLES[0])]
+        area = lambda i: [q[0] for q in engine.area(*[angle[[i]] for angle in angles], UB = UB,
+                                                    energy = ENERGY * 1000)]
+        if peak is None:
+            # the peak sits at the detector centre in the middle of the first scan
+            peak = [q[size // 2, size // 2] for q in area(frames // 2)]
+
+        os.makedirs(os.path.dirname(pyRSM.image_path_template(file_name, scan_num)), exist_ok=True)
+        for i in range(frames):
+            img = frame_intensity(*area(i), peak, rng, sparsity)
+            Image.fromarray(img).save(pyRSM.image_path_template(file_name, scan_num).format(i))
+
+    with open(file_name + '.spec', 'w') as f:
+        f.write('\n'.join(spec) + '\n')
+    return file_name, scan_list, detector
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if not args:
+        sys.exit('usage: python benchmarks/synthetic.py <directory> [n_scans] [frames] [size] [sparsity]')
+    file_name, scan_list, detector = make_dataset(args[0], *[int(a) for a in args[1:4]],
+                                                  *[float(a) for a in args[4:5]])
+    print('Wrote scans ' + str(scan_list) + ' to ' + file_name + '.spec')
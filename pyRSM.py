@@ -6,89 +6,835 @@ import os
 import plotly
 import plotly.graph_objects as go
 import glob
-
-from PIL import Image
+import hashlib
+import io
+import time
+import tracemalloc
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+
+from PIL import Image, ImageDraw
+import h5py
 
 import vtk
 from vtk.util import numpy_support
 
-def load_convert(file_name, scan_num):
-    # it loads a certain scan with CCD images and calculate the corresponding h,k,l coordinates
-    
-    sf = silx.io.open(file_name + '.spec');
+DETECTOR = dict(
+    detectorDir1 = 'x-', detectorDir2 = 'z-',
+    cch1 = 188, cch2 = 146,
+    Nch1 = 516, Nch2 = 516,
+    pwidth1 = 28.38/516, pwidth2 = 28.38/516,
+    distance = 770
+)
+# keyword arguments of hxrd.Ang2Q.init_area, first inner dimension, then outer dimension.
+# Nch1 x Nch2 is also the shape of one detector image.
+# Two optional entries restrict the pixels that are loaded (see detector_with):
+#   roi: [i1_start, i1_stop, i2_start, i2_stop], channels cropped from every image at load time,
+#        the geometry passed to init_area is adjusted to the cropped images (see detector_geometry)
+#   mask: boolean Nch1 x Nch2 array, False for bad pixels and chip gaps, which are set to 0 at load
+#         time and therefore never gridded
+#   binning: b, the (roi of the) images are summed into b x b super-pixels at load time and h,k,l is
+#            computed for the super-pixel centres only. Channels left over at the high end are dropped.
+
+QCONV = dict(sampleAxis = ['x+','z-','y+','z-'], detectorAxis = ['x+','z-'], r_i = [0,1,0])
+# the diffractometer circles passed to xu.QConversion, sample axes mu, eta, chi, phi
+# and detector axes nu, delta
+
+HKL_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'pyRSM', 'hkl')
+HKL_CACHE_SIZE = 50 * 2**30
+
+# the active PipelineProfile, set within its with block
+PROFILE = None
+
+class PipelineProfile:
+    # Opt-in instrumentation of the conversion pipeline. Within
+    #     with PipelineProfile() as profile:
+    #         rsm_convert(...)
+    # every stage of every scan records {'scan', 'stage', 'time', 'frames', 'bytes_read', 'peak_memory'}
+    # in profile.records, and passes it to callback(record) as soon as the stage is done.
+    # The stages are 'spec' (reading the scan from the spec file), 'decode' (tif decoding),
+    # 'mask' (pixel mask, done in 'decode' with a detector binning), 'normalize' (division by I0),
+    # 'convert' (angles to h,k,l), 'select' (picking the pixels with intensity > 0) and 'grid'
+    # (binning into the gridder).
+    # peak_memory is the most memory allocated during the stage on top of what was allocated before,
+    # traced with tracemalloc (None with trace_memory = False, tracing slows down Python code).
+    # Python < 3.9 cannot reset the tracemalloc peak, there it is the peak since the profile started,
+    # an upper bound of the peak of the stage.
+    # The frames skipped by the hklrange culling are kept per scan in profile.skipped as
+    # (skipped, frames).
+    # Stages running in worker processes (n_workers) are not recorded.
+    def __init__(self, callback = None, trace_memory = True):
+        self.callback = callback
+        self.trace_memory = trace_memory
+        self.records = []
+        self.skipped = OrderedDict()
+        # scan and number of frames of the last stage, for the stages that do not know theirs
+        self.scan = None
+        self.frames = 0
+        self.previous = None
+        self.started_tracing = False
+
+    def __enter__(self):
+        global PROFILE
+        self.previous = PROFILE
+        PROFILE = self
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracing = True
+        return self
+
+    def __exit__(self, *args):
+        global PROFILE
+        PROFILE = self.previous
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+
+    def add(self, record):
+        self.records.append(record)
+        if self.callback is not None:
+            self.callback(record)
+
+    def summary(self, by = 'stage'):
+        # The records added up per 'stage' or per 'scan': total time and bytes read, largest peak memory,
+        # and the frames processed (per scan the frames of the stage that processed the most).
+        totals = OrderedDict()
+        frames = OrderedDict()
+        for record in self.records:
+            key = record[by]
+            total = totals.setdefault(key, dict(time = 0., frames = 0, bytes_read = 0, peak_memory = None))
+            total['time'] += record['time']
+            total['bytes_read'] += record['bytes_read']
+            if record['peak_memory'] is not None:
+                total['peak_memory'] = max(total['peak_memory'] or 0, record['peak_memory'])
+            other = record['scan' if by == 'stage' else 'stage']
+            frames[key, other] = frames.get((key, other), 0) + record['frames']
+        for (key, other), n in frames.items():
+            totals[key]['frames'] = totals[key]['frames'] + n if by == 'stage' else max(totals[key]['frames'], n)
+        return totals
+
+@contextmanager
+def stage(name, scan = None, frames = None, bytes_read = 0):
+    # Records a stage of the pipeline in the active PipelineProfile, without one it does nothing.
+    # Without scan and frames, the stage belongs to the scan and frames of the previous stage.
+    # Yields the record, so counts can still be set inside the block.
+    profile = PROFILE
+    if profile is None:
+        yield {}
+        return
+    if scan is None:
+        scan = profile.scan
+        frames = profile.frames if frames is None else frames
+    frames = frames or 0
+    profile.scan, profile.frames = scan, frames
+    record = dict(scan = scan, stage = name, time = 0., frames = int(frames), bytes_read = int(bytes_read),
+                  peak_memory = None)
+    tracing = profile.trace_memory and tracemalloc.is_tracing()
+    if tracing:
+        start = tracemalloc.get_traced_memory()[0]
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+    t0 = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record['time'] = time.perf_counter() - t0
+        if tracing:
+            record['peak_memory'] = tracemalloc.get_traced_memory()[1] - start
+        profile.add(record)
+
+def detector_with(detector = None, roi = None, mask = None, binning = None):
+    # a copy of the detector parameters (default DETECTOR) with a roi, pixel mask and/or binning, see DETECTOR
+    detector = dict(DETECTOR if detector is None else detector)
+    if roi is not None:
+        detector['roi'] = [int(i) for i in roi]
+    if mask is not None:
+        detector['mask'] = np.asarray(mask, dtype=bool)
+    if binning is not None:
+        detector['binning'] = int(binning)
+    # fails early on a roi, mask or binning that does not fit the detector
+    detector_geometry(detector)
+    return detector
+
+def detector_geometry(detector = None):
+    # The init_area keyword arguments for the images as loaded with a detector (default DETECTOR):
+    # the roi shrinks Nch1, Nch2 and moves the centre channels cch1, cch2 into the cropped image,
+    # the binning b divides the channels and multiplies the pixel widths by b, with the centre
+    # channels at (cch + 0.5) / b - 0.5 in super-pixels. The mask is left out.
+    # Raises ValueError for a roi outside the detector, a mask that is not Nch1 x Nch2 or a binning
+    # larger than the (roi of the) image.
+    detector = dict(DETECTOR if detector is None else detector)
+    mask = detector.pop('mask', None)
+    roi = detector.pop('roi', None)
+    b = detector.pop('binning', 1)
+    shape = (detector['Nch1'], detector['Nch2'])
+    if mask is not None and np.shape(mask) != shape:
+        raise ValueError('The mask has shape ' + str(np.shape(mask)) + ', the detector is ' + str(shape) + '.')
+    if roi is not None:
+        if len(roi) != 4:
+            raise ValueError('The roi needs 4 channels [i1_start, i1_stop, i2_start, i2_stop], got '
+                             + str(roi) + '.')
+        i1_start, i1_stop, i2_start, i2_stop = roi
+        if not (0 <= i1_start < i1_stop <= shape[0] and 0 <= i2_start < i2_stop <= shape[1]):
+            raise ValueError('The roi ' + str(list(roi)) + ' is not inside the ' + str(shape[0]) + ' x '
+                             + str(shape[1]) + ' detector.')
+        detector.update(Nch1 = i1_stop - i1_start, cch1 = detector['cch1'] - i1_start,
+                        Nch2 = i2_stop - i2_start, cch2 = detector['cch2'] - i2_start)
+    if b < 1 or b > min(detector['Nch1'], detector['Nch2']):
+        raise ValueError('The binning ' + str(b) + ' does not fit the ' + str(detector['Nch1']) + ' x '
+                         + str(detector['Nch2']) + ' image.')
+    if b > 1:
+        detector.update(Nch1 = detector['Nch1'] // b, cch1 = (detector['cch1'] + 0.5) / b - 0.5,
+                        pwidth1 = detector['pwidth1'] * b,
+                        Nch2 = detector['Nch2'] // b, cch2 = (detector['cch2'] + 0.5) / b - 0.5,
+                        pwidth2 = detector['pwidth2'] * b)
+    return detector
+
+def image_path_template(file_name, scan_num):
+    # The path of the detector frames of a scan, with a {:05d} field for the frame number.
+    # The images are looked up in images/Sxxx/ next to the spec file.
+    scan_dir = 'S' + str(scan_num).zfill(3)
+    return os.path.join(os.path.dirname(file_name), 'images', scan_dir,
+                        os.path.basename(file_name) + '_' + scan_dir + '_{:05d}.tif')
+
+def load_images(file_name, scan_num, frames, I0 = None, dtype = np.float64, n_threads = None, detector = None):
+    # Decodes the tif frames of a scan on a thread pool into one preallocated (frames, Nch1, Nch2) stack.
+    # frames: number of frames to load, or a list of frame numbers
+    # I0: normalization for every scan point, the stack is divided by I0 after loading
+    # dtype: dtype of the image stack
+    # n_threads: number of decoding threads, None lets ThreadPoolExecutor decide
+    # detector: detector parameters (see DETECTOR) giving the image shape, roi, pixel mask and binning
+    if np.ndim(frames) == 0:
+        frames = np.arange(frames)
+    frames = np.asarray(frames, dtype=int)
+    template = image_path_template(file_name, scan_num)
+    paths = [template.format(img_num) for img_num in frames]
+
+    missing = [int(img_num) for img_num, path in zip(frames, paths) if not os.path.isfile(path)]
+    if missing:
+        raise FileNotFoundError('Scan ' + str(scan_num) + ': missing detector frames ' + str(missing)
+                                + ' (' + template + ')')
+
+    detector = DETECTOR if detector is None else detector
+    geometry = detector_geometry(detector)
+    roi = detector.get('roi')
+    mask = detector.get('mask')
+    if mask is not None and roi is not None:
+        mask = mask[roi[0]:roi[1], roi[2]:roi[3]]
+    b = detector.get('binning', 1)
+    n1, n2 = geometry['Nch1'] * b, geometry['Nch2'] * b
+
+    def read(idx):
+        with Image.open(paths[idx]) as im:
+            # PIL boxes are (left, upper, right, lower), i.e. (i2_start, i1_start, i2_stop, i1_stop).
+            # crop loads the whole frame first, the roi saves memory and conversion but not decoding.
+            img = np.asarray(im if roi is None else im.crop((roi[2], roi[0], roi[3], roi[1])))
+        if b == 1:
+            imgs[idx] = img
+            return
+        # masked pixels are left out of the sum of their super-pixel
+        img = img[:n1, :n2] if mask is None else np.where(mask, img, 0)[:n1, :n2]
+        imgs[idx] = img.reshape(n1 // b, b, n2 // b, b).sum(axis=(1, 3), dtype=dtype)
+
+    with stage('decode', scan_num, len(frames)) as record:
+        if record:
+            record['bytes_read'] = sum(os.path.getsize(path) for path in paths)
+        # allocated inside the stage, so that its peak_memory includes the stack
+        imgs = np.empty((len(frames), geometry['Nch1'], geometry['Nch2']), dtype=dtype)
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            list(pool.map(read, range(len(frames))))
+
+    if mask is not None and b == 1:
+        with stage('mask', scan_num, len(frames)):
+            imgs[:, ~mask] = 0
+
+    if I0 is not None:
+        with stage('normalize', scan_num, len(frames)):
+            imgs /= np.asarray(I0)[frames, None, None]
+    return imgs
+
+def scan_motor(scan, name, length):
+    # the motor position of every scan point, read from the scanned counters
+    # or from the fixed positioners when the motor was not scanned
+    try:
+        return scan['measurement/' + name].value
+    except:
+        return scan['instrument/positioners/' + name].value * np.ones(length)
+
+def load_scan(file_name, scan_num, sf = None, detector = None, qconv = None):
+    # Reads the scan information from the spec file: the number of points, the I0 normalization
+    # (and the mean I0 it is normalized by), the UB matrix, the energy (eV) and the diffractometer angles [mu, eta, chi, phi, nu, delta].
+    # The detector and diffractometer geometry used for the conversion (default DETECTOR and QCONV)
+    # is stored along.
+    # sf: an already opened spec file, otherwise the file is opened and closed here
+    if sf is None:
+        with stage('spec', scan_num), silx.io.open(file_name + '.spec') as sf:
+            return load_scan(file_name, scan_num, sf, detector, qconv)
 
     # ============ load spec file and motor position====================
     scan = sf[str(scan_num) + '.1']
     length = len(scan['measurement/Epoch'].value)
     I0 = np.array(scan['measurement/Ion_Ch_4'].value)
-    I0 /= np.nanmean(I0)
-
-    #     =============== load images =============
-    try:
-        imgs = np.zeros((length,516, 516))
-        for img_num in np.arange(length):
-            im = Image.open('images\\S' + str(scan_num).zfill(3) + '\\'+ file_name +'_S' + str(scan_num).zfill(3)+ '_'+str(int(img_num)).zfill(5)+'.tif')
-            imgs[img_num,:,:] = im/I0[img_num]
-    except:
-        print('Number of images does not equal scan point number.')
-        return None
+    I0_mean = np.nanmean(I0) if length else 1.
+    I0 /= I0_mean
 
     # ========== load sample geometry ==============
-    UB = np.array(scan['sample/ub_matrix'].value)[0]
+    UB = np.array(scan['sample/ub_matrix'].value, dtype=float)[0]
     energy = float(scan['instrument/specfile/scan_header'][18].split(' ')[1])*1000
 
-    try:
-        delta = scan['measurement/Delta'].value
-    except:
-        delta = scan['instrument/positioners/Delta'].value * np.ones(length)
-
-    try:
-        eta = scan['measurement/Eta'].value
-    except:
-        eta = scan['instrument/positioners/Eta'].value * np.ones(length)
-
-    try:
-        chi = scan['measurement/Chi'].value
-    except:
-        chi = scan['instrument/positioners/Chi'].value * np.ones(length)
-
-    try:
-        phi = scan['measurement/Phi'].value
-    except:
-        phi = scan['instrument/positioners/Phi'].value * np.ones(length)
-
-    try:
-        nu = scan['measurement/Nu'].value
-    except:
-        nu = scan['instrument/positioners/Nu'].value * np.ones(length)
-
-    try:
-        mu = scan['measurement/Mu'].value
-    except:
-        mu = scan['instrument/positioners/Mu'].value * np.ones(length)
-
-    # #     ================= load diffractometer geometry ==================
+    angles = [scan_motor(scan, name, length) for name in ['Mu', 'Eta', 'Chi', 'Phi', 'Nu', 'Delta']]
+    return dict(length = length, I0 = I0, I0_mean = I0_mean, UB = UB, energy = energy, angles = angles,
+                detector = DETECTOR if detector is None else detector,
+                qconv = QCONV if qconv is None else qconv)
 
-    qconversion = xu.QConversion(sampleAxis = ['x+','z-','y+','z-'], detectorAxis = ['x+','z-'], r_i = [0,1,0])
+def init_hxrd(energy, detector = None, qconv = None):
+    # the diffractometer and detector geometry used for the angle to hkl conversion
+    qconversion = xu.QConversion(**(QCONV if qconv is None else qconv))
 
     hxrd = xu.HXRD( [0,1,0], [0,0,1], en = energy, qconv =  qconversion)
 
-    hxrd.Ang2Q.init_area(
-            'x-', 'z-',
-            cch1=188, cch2=146,
-            Nch1=516, Nch2=516,
-            pwidth1=28.38/516, pwidth2=28.38/516,
-            distance=770
-        )
-    # # first inner dimension, then outer dimension
+    hxrd.Ang2Q.init_area(**detector_geometry(detector))
+    return hxrd
+
+def axis_vector(axis):
+    # unit vector of an xrayutilities axis string like 'x+' or 'z-'
+    return np.eye(3)['xyz'.index(axis[0])] * (1 if axis[1] == '+' else -1)
+
+def rotation_matrices(axis, angles):
+    # right-handed rotation matrices around an axis string for an array of angles in degree
+    u = axis_vector(axis)
+    K = np.array([[0, -u[2], u[1]], [u[2], 0, -u[0]], [-u[1], u[0], 0]])
+    a = np.radians(np.atleast_1d(angles))[:, None, None]
+    return np.eye(3) + np.sin(a) * K + (1 - np.cos(a)) * (K @ K)
+
+class QEngine:
+    # Angle to h,k,l conversion of the area detector in NumPy, for the geometry of init_hxrd.
+    # The unit direction of every detector pixel is computed once when the engine is built, a frame then
+    # only needs its sample and detector rotation matrices R_s and R_d:
+    #     hkl = (R_s UB)^-1 k0 (R_d r_pixel - r_i)
+    # which is one (frames, 3) x (3, pixels) matrix product per h, k and l.
+    # Detector tilt and rotation (tilt, tiltazimuth, detrot of init_area) are not supported.
+    # dtype: dtype of the direction table and of the returned qx, qy, qz
+    def __init__(self, detector = None, qconv = None, dtype = np.float64):
+        detector = detector_geometry(detector)
+        qconv = QCONV if qconv is None else qconv
+        self.sample_axes = qconv['sampleAxis']
+        self.detector_axes = qconv['detectorAxis']
+        self.dtype = np.dtype(dtype)
+        self.shape = (detector['Nch1'], detector['Nch2'])
+
+        r_i = np.asarray(qconv['r_i'], dtype=float)
+        self.r_i = r_i / np.linalg.norm(r_i)
+        ch1 = (np.arange(detector['Nch1']) - detector['cch1']) * detector['pwidth1']
+        ch2 = (np.arange(detector['Nch2']) - detector['cch2']) * detector['pwidth2']
+        pixels = (self.r_i * detector['distance']
+                  + ch1[:, None, None] * axis_vector(detector['detectorDir1'])
+                  + ch2[None, :, None] * axis_vector(detector['detectorDir2']))
+        pixels /= np.linalg.norm(pixels, axis=-1, keepdims=True)
+        # (3, pixels) table of the pixel directions
+        self.directions = np.ascontiguousarray(pixels.reshape(-1, 3).T, dtype=self.dtype)
+
+    def matrices(self, angles, UB, energy):
+        # per frame matrices A, b with hkl = A r_pixel - b
+        n = len(self.sample_axes)
+        R_s = np.eye(3)
+        for axis, angle in zip(self.sample_axes, angles[:n]):
+            R_s = R_s @ rotation_matrices(axis, angle)
+        R_d = np.eye(3)
+        for axis, angle in zip(self.detector_axes, angles[n:]):
+            R_d = R_d @ rotation_matrices(axis, angle)
+        k0 = 2 * np.pi / xu.en2lam(energy)
+        M = k0 * np.linalg.inv(R_s @ np.asarray(UB, dtype=float))
+        return M @ R_d, M @ self.r_i
+
+    def area(self, *angles, UB, energy):
+        # qx, qy, qz of shape (frames, Nch1, Nch2) for the angles [mu, eta, chi, phi, nu, delta],
+        # the same as hxrd.Ang2Q.area(*angles, UB=UB) with arrays of angles
+        length = max(np.size(angle) for angle in angles)
+        angles = [np.broadcast_to(np.asarray(angle, dtype=float).ravel(), (length,)) for angle in angles]
+        A, b = self.matrices(angles, UB, energy)
+        A = A.astype(self.dtype)
+        b = b.astype(self.dtype)
+        hkl = []
+        for i in range(3):
+            q = A[:, i, :] @ self.directions
+            q -= b[:, i, None]
+            hkl.append(q.reshape((length,) + self.shape))
+        return hkl
+
+QENGINES = {}
+
+def get_qengine(dtype = np.float64, detector = None, qconv = None):
+    # the QEngine of a geometry (default DETECTOR and QCONV), built once per configuration
+    detector = detector_geometry(detector)
+    qconv = QCONV if qconv is None else qconv
+    key = (repr(sorted(detector.items())), repr(sorted(qconv.items())), np.dtype(dtype).str)
+    if key not in QENGINES:
+        QENGINES[key] = QEngine(detector, qconv, dtype)
+    return QENGINES[key]
+
+def hkl_converter(info, converter = 'xu', dtype = np.float64):
+    # Returns a function giving qx, qy, qz of a list of frames of a scan loaded with load_scan.
+    # converter: 'xu' for hxrd.Ang2Q.area, 'numpy' for the QEngine (which can return float32 with dtype)
+    # dtype: dtype of qx, qy, qz, xrayutilities computes in float64 and the result is cast
+    if converter == 'numpy':
+        engine = get_qengine(dtype, info['detector'], info['qconv'])
+        return lambda frames: engine.area(*[angle[frames] for angle in info['angles']],
+                                          UB=info['UB'], energy=info['energy'])
+    if converter != 'xu':
+        raise ValueError('Unknown converter ' + repr(converter) + ", use 'xu' or 'numpy'")
+    hxrd = init_hxrd(info['energy'], info['detector'], info['qconv'])
+    geometry = detector_geometry(info['detector'])
+    shape = (-1, geometry['Nch1'], geometry['Nch2'])
+
+    def convert(frames):
+        # xrayutilities drops the frame axis of a single frame, which the chunked mode hits whenever
+        # a chunk holds one frame (e.g. the last chunk of k * chunk + 1 frames)
+        hkl = hxrd.Ang2Q.area(*[angle[frames] for angle in info['angles']], UB=info['UB'])
+        return [q.reshape(shape).astype(dtype, copy=False) for q in hkl]
+    return convert
+
+def frame_bounds(info, frames = slice(None), step = 16):
+    # Cheap bounding boxes of the h,k,l footprints of frames of a scan loaded with load_scan, from
+    # a lattice of every step-th pixel, edges included, converted with the QEngine. The boxes are
+    # widened by the largest change between neighbouring lattice pixels, which bounds the footprint
+    # between them. Returns lo, hi of shape (frames, 3).
+    detector = detector_geometry(info['detector'])
+    lattice = dict(detector,
+                   Nch1 = -(-(detector['Nch1'] - 1) // step) + 1, cch1 = detector['cch1'] / step,
+                   pwidth1 = detector['pwidth1'] * step,
+                   Nch2 = -(-(detector['Nch2'] - 1) // step) + 1, cch2 = detector['cch2'] / step,
+                   pwidth2 = detector['pwidth2'] * step)
+    hkl = np.array(get_qengine(np.float64, lattice, info['qconv']).area(
+        *[np.atleast_1d(angle[frames]) for angle in info['angles']], UB=info['UB'], energy=info['energy']))
+    margin = (np.abs(np.diff(hkl, axis=2)).max(axis=(2, 3))
+              + np.abs(np.diff(hkl, axis=3)).max(axis=(2, 3)))
+    return (hkl.min(axis=(2, 3)) - margin).T, (hkl.max(axis=(2, 3)) + margin).T
+
+def frames_in_range(info, hklrange, frames = None, step = 16):
+    # the frames of a scan (default all) whose h,k,l footprint can overlap hklrange, see frame_bounds
+    frames = np.arange(info['length']) if frames is None else np.asarray(frames, dtype=int)
+    if len(frames) == 0:
+        return frames
+    lo, hi = frame_bounds(info, frames, step)
+    hklrange = np.asarray(hklrange, dtype=float)
+    return frames[np.all((hi >= hklrange[:, 0]) & (lo <= hklrange[:, 1]), axis=1)]
+
+def cull_frames(info, hklrange, scan_num = None, verbose = False):
+    # frames_in_range of a scan. The number of skipped frames is kept in the skipped dict of the active
+    # PipelineProfile, and printed with verbose.
+    frames = frames_in_range(info, hklrange)
+    skipped = info['length'] - len(frames)
+    if PROFILE is not None:
+        PROFILE.skipped[scan_num] = (skipped, info['length'])
+    if verbose:
+        print('Scan ' + str(scan_num) + ': ' + str(skipped) + ' of ' + str(info['length'])
+              + ' frames outside hklrange skipped')
+    return frames
+
+def hkl_cache_key(info):
+    # hash of everything the h,k,l coordinates of a scan depend on: the motor positions, the UB matrix,
+    # the energy and the diffractometer and detector geometry
+    key = hashlib.sha1()
+    for angle in info['angles']:
+        key.update(np.ascontiguousarray(angle, dtype=np.float64).tobytes())
+    key.update(np.ascontiguousarray(info['UB'], dtype=np.float64).tobytes())
+    key.update(repr(float(info['energy'])).encode())
+    key.update(repr(sorted(detector_geometry(info['detector']).items())).encode())
+    key.update(repr(sorted(info['qconv'].items())).encode())
+    return key.hexdigest()
+
+def cached_hkl(info, cache_dir = None, max_size = HKL_CACHE_SIZE, max_memory = 2**30, converter = 'xu'):
+    # The h,k,l coordinates of a scan loaded with load_scan, as a read-only memory-mapped
+    # (3, frames, Nch1, Nch2) array from the on-disk cache. A missing entry is computed chunk by chunk
+    # into the cache first, then the least recently used entries are evicted down to max_size bytes.
+    # cache_dir: cache directory, default HKL_CACHE_DIR
+    cache_dir = cache_dir or HKL_CACHE_DIR
+    path = os.path.join(cache_dir, hkl_cache_key(info) + '.npy')
+    if os.path.isfile(path):
+        # marks the entry as recently used for the eviction, which a read-only cache cannot record
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return np.load(path, mmap_mode='r')
+
+    os.makedirs(cache_dir, exist_ok=True)
+    convert = hkl_converter(info, converter)
+    geometry = detector_geometry(info['detector'])
+    tmp_path = path[:-4] + '.' + str(os.getpid()) + '.tmp'
+    hkl = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float64,
+                                    shape=(3, info['length'], geometry['Nch1'], geometry['Nch2']))
+    for frames in chunk_frames(info['length'], max_memory, info['detector']):
+        hkl[:, frames] = convert(frames)
+    hkl.flush()
+    del hkl
+    os.replace(tmp_path, path)
+    evict_hkl_cache(cache_dir, max_size, keep = path)
+    return np.load(path, mmap_mode='r')
+
+def evict_hkl_cache(cache_dir = None, max_size = HKL_CACHE_SIZE, keep = None):
+    # removes the least recently used entries until the cache holds at most max_size bytes
+    cache_dir = cache_dir or HKL_CACHE_DIR
+    entries = sorted(glob.glob(os.path.join(cache_dir, '*.npy')), key=os.path.getmtime)
+    size = sum(os.path.getsize(path) for path in entries)
+    for path in entries:
+        if size <= max_size:
+            break
+        if path != keep:
+            size -= os.path.getsize(path)
+            os.remove(path)
+
+def clear_hkl_cache(cache_dir = None):
+    # removes all entries of the h,k,l cache
+    evict_hkl_cache(cache_dir, max_size = 0)
+
+def load_convert(file_name, scan_num, dtype = np.float64, n_threads = None, cache_dir = None,
+            converter = 'xu', detector = None, qconv = None, hklrange = None, roi = None, mask = None,
+            binning = None):
+    # it loads a certain scan with CCD images and calculate the corresponding h,k,l coordinates
+    # dtype: dtype of the returned image stack and of qx, qy, qz, np.float32 halves the memory
+    #        (the h,k,l cache stays float64 and is cast when read)
+    # n_threads: number of threads decoding the tif frames
+    # cache_dir: if given (True for the default HKL_CACHE_DIR), qx, qy, qz are read from the
+    #            on-disk cache as memory-mapped arrays, and computed into it on the first call
+    # converter: 'xu' converts with hxrd.Ang2Q.area, 'numpy' with the vectorized QEngine,
+    #            whose qx, qy, qz then have the dtype of the image stack
+    # detector, qconv: detector and diffractometer geometry, default DETECTOR and QCONV
+    # hklrange: if given, only the frames whose h,k,l footprint can overlap it are loaded and
+    #           converted (see frames_in_range)
+    # roi, mask: detector region [i1_start, i1_stop, i2_start, i2_stop] and boolean mask of the good
+    #            pixels, see DETECTOR. The frames are cropped to the roi right after decoding, so only
+    #            the roi is stored and converted, the images and qx, qy, qz have the shape of the roi.
+    # binning: sum the images into binning x binning super-pixels and convert only their centres,
+    #          which cuts the conversion time and the memory by about binning**2 (see DETECTOR)
+    if roi is not None or mask is not None or binning is not None:
+        detector = detector_with(detector, roi, mask, binning)
+    info = load_scan(file_name, scan_num, detector = detector, qconv = qconv)
+    frames = None if hklrange is None else cull_frames(info, hklrange, scan_num)
+    return convert_scan(file_name, scan_num, info, dtype, n_threads, cache_dir, converter, frames)
+
+def convert_scan(file_name, scan_num, info, dtype = np.float64, n_threads = None, cache_dir = None,
+            converter = 'xu', frames = None):
+    # the image stack and qx, qy, qz of a scan whose spec information is already loaded, see load_convert
+    # frames: the frames to load, default all
+
+    #     =============== load images =============
+    imgs = load_images(file_name, scan_num, info['length'] if frames is None else frames, I0 = info['I0'],
+                       dtype = dtype, n_threads = n_threads, detector = info['detector'])
+    if len(imgs) == 0:
+        return imgs, imgs.copy(), imgs.copy(), imgs.copy()
 
     # #     ================= angle to hkl ====================
-    angle_values =   [mu, eta, chi, phi, nu, delta]   #[[26.056],  [13.028]]
-    qx, qy, qz = hxrd.Ang2Q.area(*angle_values, UB=UB)
+    frames = slice(None) if frames is None else frames
+    with stage('convert', scan_num, len(imgs)):
+        if cache_dir:
+            hkl = cached_hkl(info, None if cache_dir is True else cache_dir, converter = converter)[:, frames]
+            qx, qy, qz = hkl if hkl.dtype == dtype else hkl.astype(dtype)
+        else:
+            qx, qy, qz = hkl_converter(info, converter, dtype)(frames)
     return imgs, qx, qy, qz
 
+# bytes held per detector pixel while a chunk of frames is gridded: the image, qx, qy, qz,
+# the imgs>0 selections of all four and the float64 copies made by the gridder
+BYTES_PER_PIXEL = 12 * 8
+
+def chunk_frames(length, max_memory, detector = None):
+    # splits the frames of a scan into chunks that fit into max_memory bytes
+    detector = detector_geometry(detector)
+    frame_bytes = detector['Nch1'] * detector['Nch2'] * BYTES_PER_PIXEL
+    n = int(max(1, max_memory // frame_bytes))
+    return [np.arange(i, min(i + n, length)) for i in range(0, length, n)]
+
+class NumpyGridder3D:
+    # A 3D gridder with the interface and binning of xu.Gridder3D, accumulating with np.bincount.
+    # The axes run from min to max with the voxel centres on the end points, and points outside
+    # the range are dropped. Besides the intensity sum it keeps the number of hits of every voxel,
+    # so empty voxels are exactly the ones with count == 0.
+    # dtype: dtype of the sum accumulator, float32 halves the memory of the grid.
+    def __init__(self, nx, ny, nz, dtype = np.float64):
+        self.nx, self.ny, self.nz = nx, ny, nz
+        self.dtype = np.dtype(dtype)
+        self.keep_data = False
+        self.fixed_range = False
+        self.xmin, self.xmax, self.ymin, self.ymax, self.zmin, self.zmax = [0.]*6
+        self.allocate()
+
+    def allocate(self):
+        self.sum = np.zeros((self.nx, self.ny, self.nz), dtype=self.dtype)
+        self.count = np.zeros((self.nx, self.ny, self.nz), dtype=np.int64 if self.dtype == np.float64 else np.int32)
+
+    def KeepData(self, keep):
+        self.keep_data = keep
+
+    def dataRange(self, xmin, xmax, ymin, ymax, zmin, zmax, fixed = True):
+        self.fixed_range = fixed
+        self.xmin, self.xmax = xmin, xmax
+        self.ymin, self.ymax = ymin, ymax
+        self.zmin, self.zmax = zmin, zmax
+
+    def Clear(self):
+        self.sum[...] = 0
+        self.count[...] = 0
+
+    xaxis = property(lambda self: xu.gridder.axis(self.xmin, self.xmax, self.nx))
+    yaxis = property(lambda self: xu.gridder.axis(self.ymin, self.ymax, self.ny))
+    zaxis = property(lambda self: xu.gridder.axis(self.zmin, self.zmax, self.nz))
+
+    def index(self, x, y, z):
+        # linear voxel index of every point (C order of the grid) and the mask of points inside the range
+        x, y, z = [np.ravel(a) for a in (x, y, z)]
+        if not self.fixed_range:
+            self.dataRange(x.min(), x.max(), y.min(), y.max(), z.min(), z.max(), self.keep_data)
+        axes = [(x, self.xmin, self.xmax, self.nx), (y, self.ymin, self.ymax, self.ny),
+                (z, self.zmin, self.zmax, self.nz)]
+        inside = np.ones(x.shape, dtype=bool)
+        for a, a_min, a_max, n in axes:
+            inside &= a >= a_min
+            inside &= a <= a_max
+        all_inside = inside.all()
+        idx = 0
+        for a, a_min, a_max, n in axes:
+            f = a - a_min if all_inside else a[inside] - a_min
+            f /= xu.gridder.delta(a_min, a_max, n)
+            idx = idx * n + np.rint(f, out=f).astype(np.intp)
+        return idx, (slice(None) if all_inside else inside)
+
+    def add(self, idx, data):
+        # Adds the data of points with known linear voxel indices to the running sums. np.bincount
+        # is the fastest but builds a float64 array of the grid size, so sparse calls on large grids
+        # go through np.add.at instead.
+        if len(idx) >= self.sum.size:
+            self.sum += np.bincount(idx, weights=data, minlength=self.sum.size).reshape(self.sum.shape)
+            self.count += np.bincount(idx, minlength=self.count.size).reshape(self.count.shape)
+        else:
+            np.add.at(self.sum.reshape(-1), idx, data.astype(self.dtype, copy=False))
+            np.add.at(self.count.reshape(-1), idx, 1)
+
+    def __call__(self, x, y, z, data):
+        if not self.keep_data:
+            self.Clear()
+        idx, inside = self.index(x, y, z)
+        self.add(idx, np.ravel(data)[inside])
+
+    @property
+    def data(self):
+        # mean intensity of every voxel, NaN where there is no hit
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.count > 0, self.sum / self.count, np.nan).astype(self.dtype, copy=False)
+
+class SparseGrid:
+    # A 3D array stored as cubic blocks, of which only the blocks that were written to are allocated.
+    # All other voxels have the fill value (0 for sums and counts, NaN for a normalized map).
+    # Indexing with integers and slices returns a dense NumPy array of the selected region, so slices
+    # of a sparse map can be used like slices of a dense one.
+    # shape: shape of the full array
+    # block: edge length of the blocks in voxels
+    def __init__(self, shape, dtype = np.float64, fill = 0, block = 16):
+        self.shape = tuple(shape)
+        self.ndim = 3
+        self.dtype = np.dtype(dtype)
+        self.fill = fill
+        self.block = block
+        self.blocks = {}
+
+    @property
+    def nbytes(self):
+        return len(self.blocks) * self.block**3 * self.dtype.itemsize
+
+    def group(self, idx):
+        # Splits linear (C order) voxel indices by block. Returns the order sorting idx by block and,
+        # for every block hit, its key, the offsets of the voxels in the block and their range in
+        # the sorted order.
+        B = self.block
+        ijk = np.unravel_index(idx, self.shape)
+        n_blocks = [-(-n // B) for n in self.shape]
+        keys = np.ravel_multi_index([i // B for i in ijk], n_blocks)
+        offsets = np.ravel_multi_index([i % B for i in ijk], (B, B, B))
+        order = np.argsort(keys, kind='stable')
+        keys, offsets = keys[order], offsets[order]
+        starts = np.flatnonzero(np.diff(keys, prepend=-1))
+        ends = np.append(starts[1:], len(keys))
+        groups = [(np.unravel_index(keys[start], n_blocks), offsets[start:end], slice(start, end))
+                  for start, end in zip(starts, ends)]
+        return order, groups
+
+    def add_at(self, idx, values):
+        # adds values at linear (C order) voxel indices
+        order, groups = self.group(idx)
+        values = np.asarray(values)[order]
+        B = self.block
+        for key, offsets, sel in groups:
+            if key not in self.blocks:
+                self.blocks[key] = np.full((B, B, B), self.fill, dtype=self.dtype)
+            np.add.at(self.blocks[key].reshape(-1), offsets, values[sel])
+
+    def take(self, idx):
+        # the values at linear (C order) voxel indices
+        order, groups = self.group(idx)
+        out = np.full(len(order), self.fill, dtype=self.dtype)
+        for key, offsets, sel in groups:
+            if key in self.blocks:
+                out[order[sel]] = self.blocks[key].reshape(-1)[offsets]
+        return out
+
+    def nonzero(self):
+        # the sorted linear (C order) indices of the non-zero voxels
+        B = self.block
+        idx = []
+        for key, blk in self.blocks.items():
+            i, j, k = np.nonzero(blk)
+            i, j, k = i + key[0] * B, j + key[1] * B, k + key[2] * B
+            inside = (i < self.shape[0]) & (j < self.shape[1]) & (k < self.shape[2])
+            idx.append(np.ravel_multi_index((i[inside], j[inside], k[inside]), self.shape))
+        return np.sort(np.concatenate(idx)) if idx else np.zeros(0, dtype=np.intp)
+
+    def __iadd__(self, other):
+        for key, blk in other.blocks.items():
+            if key in self.blocks:
+                self.blocks[key] += blk
+            else:
+                self.blocks[key] = blk.astype(self.dtype)
+        return self
+
+    def map(self, func):
+        # a new SparseGrid with func applied to every voxel, e.g. np.log
+        out = SparseGrid(self.shape, self.dtype, func(np.array(self.fill, dtype=self.dtype)), self.block)
+        out.blocks = {key: func(blk) for key, blk in self.blocks.items()}
+        return out
+
+    def values(self):
+        # the non-NaN values of the allocated blocks, for percentiles of a normalized map
+        if not self.blocks:
+            return np.zeros(0, dtype=self.dtype)
+        values = np.concatenate([blk.ravel() for blk in self.blocks.values()])
+        return values[~np.isnan(values)]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (3 - len(key))
+        box = []
+        squeeze = []
+        for axis, (k, n) in enumerate(zip(key, self.shape)):
+            if isinstance(k, slice):
+                start, stop, step = k.indices(n)
+                if step != 1:
+                    raise IndexError('SparseGrid only supports slices with step 1.')
+                box.append((start, max(start, stop)))
+            else:
+                k = int(k) + n if k < 0 else int(k)
+                box.append((k, k + 1))
+                squeeze.append(axis)
+        out = np.full([stop - start for start, stop in box], self.fill, dtype=self.dtype)
+        B = self.block
+        for key, blk in self.blocks.items():
+            src = []
+            dst = []
+            for b, (start, stop) in zip(key, box):
+                lo, hi = max(start, b * B), min(stop, (b + 1) * B)
+                if lo >= hi:
+                    break
+                src.append(slice(lo - b * B, hi - b * B))
+                dst.append(slice(lo - start, hi - start))
+            else:
+                out[tuple(dst)] = blk[tuple(src)]
+        return out.squeeze(axis=tuple(squeeze)) if squeeze else out
+
+    def to_dense(self):
+        return self[:, :, :]
+
+    def box(self):
+        # the slices of the bounding box of the allocated blocks, empty slices without any block
+        if not self.blocks:
+            return (slice(0, 0),) * 3
+        keys = np.array(list(self.blocks)).reshape(-1, 3)
+        return tuple(slice(lo * self.block, min(n, (hi + 1) * self.block))
+                     for lo, hi, n in zip(keys.min(axis=0), keys.max(axis=0), self.shape))
+
+    def crop(self, coords):
+        # the dense array and axes of the bounding box of the allocated blocks, of size 0 without any
+        box = self.box()
+        return self[box], [np.asarray(c)[b] for c, b in zip(coords, box)]
+
+class SparseGridder3D(NumpyGridder3D):
+    # NumpyGridder3D keeping the sum and count in SparseGrid blocks, for fine grids of which the
+    # detector only hits a thin shell. The points of a call are first reduced to one sum and count
+    # per hit voxel.
+    # block: edge length of the blocks in voxels
+    def __init__(self, nx, ny, nz, dtype = np.float64, block = 16):
+        self.block = block
+        NumpyGridder3D.__init__(self, nx, ny, nz, dtype)
+
+    def allocate(self):
+        shape = (self.nx, self.ny, self.nz)
+        self.sum = SparseGrid(shape, self.dtype, 0, self.block)
+        self.count = SparseGrid(shape, np.int64, 0, self.block)
+
+    def Clear(self):
+        self.allocate()
+
+    def add(self, idx, data):
+        voxels, inverse = np.unique(idx, return_inverse=True)
+        self.sum.add_at(voxels, np.bincount(inverse, weights=data))
+        self.count.add_at(voxels, np.bincount(inverse))
+
+    @property
+    def data(self):
+        return normalize_grid(self.sum, self.count, 'sparse')
+
+GRIDDERS = {'xu': xu.Gridder3D, 'numpy': NumpyGridder3D, 'sparse': SparseGridder3D}
+
+def make_gridder(gridder, h_n, k_n, l_n, hklrange, dtype = np.float64):
+    # a gridder of the selected backend ('xu', 'numpy' or 'sparse') on a fixed grid over hklrange,
+    # keeping its data over successive calls
+    if gridder not in GRIDDERS:
+        raise ValueError('Unknown gridder ' + repr(gridder) + ', use one of ' + str(list(GRIDDERS)))
+    if gridder != 'xu':
+        g = GRIDDERS[gridder](h_n, k_n, l_n, dtype = dtype)
+    else:
+        g = xu.Gridder3D(nx=h_n, ny=k_n, nz=l_n)
+    g.KeepData(True)
+    g.dataRange(
+        xmin=hklrange[0][0], xmax=hklrange[0][1],
+        ymin=hklrange[1][0], ymax=hklrange[1][1],
+        zmin=hklrange[2][0], zmax=hklrange[2][1],
+        fixed=True
+    )
+    return g
+
+def gridder_sums(g):
+    # the running intensity sum and hit count of a gridder
+    if isinstance(g, NumpyGridder3D):
+        return g.sum, g.count
+    # xu.Gridder3D keeps them in _gdata and _gnorm
+    return g._gdata, g._gnorm
+
+def normalize_grid(grid_sum, grid_count, gridder = 'xu'):
+    # The mean intensity of every voxel with empty voxels set to NaN. The xu backend keeps the
+    # historical threshold on the value, the numpy and sparse backends mark exactly the voxels
+    # without hits. Sparse sums give a SparseGrid.
+    if isinstance(grid_sum, SparseGrid):
+        grid_data = SparseGrid(grid_sum.shape, grid_sum.dtype, np.nan, grid_sum.block)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            for key, blk in grid_sum.blocks.items():
+                grid_data.blocks[key] = np.where(grid_count.blocks[key] > 0, blk / grid_count.blocks[key], np.nan)
+        return grid_data
+    grid_data = grid_sum.copy()
+    mask = grid_count != 0
+    grid_data[mask] /= grid_count[mask]
+    if gridder != 'xu':
+        grid_data[~mask] = np.nan
+    else:
+        grid_data[grid_data<0.01]= np.nan
+    return grid_data
+
 def rsm_convert(file_name, scan_list, h_n = 50, k_n = 50, l_n = 50, 
-            return_imgs = False, hklrange = None):
+            return_imgs = False, hklrange = None, max_memory = None, n_workers = None,
+            gridder = 'xu', cache_dir = None, converter = 'xu', detector = None, qconv = None,
+            roi = None, mask = None, binning = None, dtype = np.float64):
     # This program calculates the intensity at a gridded point with h_n*k_n*l_n.
     # The return is a 3d matrix, and 3* 1d lists of h,k,l.
     # input:
@@ -96,70 +842,1129 @@ def rsm_convert(file_name, scan_list, h_n = 50, k_n = 50, l_n = 50,
     # scan_list: can be a single scan number (integer) or list of number i.e. [14, 15, 16...]
     # h_n, k_n, l_n: the number of voxels in the output
     # return_imgs: boolean, whether return detector image in order to check the calculation
+    # hklrange: [[h_min, h_max], [k_min, k_max], [l_min, l_max]] of the grid, default the range of the
+    #           data. Frames whose footprint cannot overlap it are skipped before loading (see
+    #           frames_in_range), so the returned images only hold the frames used.
+    # max_memory: memory budget in bytes. If given, the frames are loaded, converted and gridded
+    #             chunk by chunk within the budget, without building the full image and q stacks.
+    # n_workers: number of processes gridding the scans in parallel, implies the chunked mode
+    #            (with a default budget of 1 GB per worker).
+    # return_imgs is not available together with max_memory or n_workers.
+    # gridder: 'xu' for xu.Gridder3D, or 'numpy' for NumpyGridder3D, which marks exactly the
+    #          voxels without any hit as NaN, or 'sparse' for SparseGridder3D, which returns
+    #          grid_data as a SparseGrid allocating only the blocks with hits
+    # cache_dir: use the on-disk h,k,l cache in this directory (True for HKL_CACHE_DIR), see load_convert
+    # converter: 'xu' or 'numpy', the angle to h,k,l conversion, see load_convert
+    # detector, qconv: detector and diffractometer geometry, default DETECTOR and QCONV
+    # roi, mask: only grid a region of the detector and/or the pixels of a boolean mask, see load_convert
+    # binning: grid binning x binning super-pixels of the detector, see load_convert. Every super-pixel
+    #          is one point carrying the summed intensity of its pixels.
+    # dtype: precision of the images, h,k,l and grid accumulators. np.float32 halves the memory of
+    #        the whole pipeline (xu.Gridder3D still accumulates in float64), the accuracy check on
+    #        the bundled scans is in benchmarks/precision_check.py
+    if roi is not None or mask is not None or binning is not None:
+        detector = detector_with(detector, roi, mask, binning)
+    if max_memory is not None or n_workers is not None:
+        if return_imgs:
+            raise ValueError('return_imgs is not available together with max_memory or n_workers.')
+        return rsm_convert_chunked(file_name, scan_list, h_n, k_n, l_n, hklrange,
+                                   max_memory or 2**30, n_workers, gridder, dtype, cache_dir = cache_dir,
+                                   converter = converter, detector = detector, qconv = qconv)
+
     if isinstance(scan_list, int):
-        imgs, qx, qy, qz = load_convert(file_name, scan_list)
-    else:
-        scan = scan_list[0]
-        imgs, qx, qy, qz = load_convert(file_name, scan)
-        for scan in scan_list[1:]:
-            imgs_temp, qx_temp, qy_temp, qz_temp = load_convert(file_name, scan)
-            imgs = np.vstack([imgs, imgs_temp])
-            qx = np.vstack([qx, qx_temp])
-            qy = np.vstack([qy, qy_temp])
-            qz = np.vstack([qz, qz_temp])
+        scan_list = [scan_list]
+    stacks = [load_convert(file_name, scan, dtype = dtype, cache_dir = cache_dir, converter = converter,
+                           detector = detector, qconv = qconv, hklrange = hklrange) for scan in scan_list]
+    return grid_stacks(stacks, h_n, k_n, l_n, hklrange, return_imgs, gridder, scan_list, dtype)
+
+def grid_stacks(stacks, h_n = 50, k_n = 50, l_n = 50, hklrange = None, return_imgs = False, gridder = 'xu',
+            scan_list = None, dtype = np.float64):
+    # Grids already loaded scans, a list of (imgs, qx, qy, qz) as returned by load_convert,
+    # one after the other into the same h_n*k_n*l_n grid. Returns like rsm_convert.
+    # scan_list: the scan numbers of the stacks, to label the stages of a PipelineProfile
+    # dtype: dtype of the grid accumulators
     
 #   ================= binning into regular grid ====================
     if hklrange == None:
-        h_min,h_max = [np.min(qx), np.max(qx)]
-        k_min,k_max = [np.min(qy), np.max(qy)]
-        l_min,l_max = [np.min(qz), np.max(qz)]
-    else:
-        h_min,h_max = hklrange[0]
-        k_min,k_max = hklrange[1]
-        l_min,l_max = hklrange[2]
-
-    gridder = xu.Gridder3D(nx=h_n, ny=k_n, nz=l_n)
-    gridder.KeepData(True)
-    gridder.dataRange(
-        xmin=h_min, xmax=h_max,
-        ymin=k_min, ymax=k_max,
-        zmin=l_min, zmax=l_max,
-        fixed=True
-    )
-    flag = imgs>0
-    gridder(qx[flag], qy[flag], qz[flag], imgs[flag])
-
-    grid_data = gridder.data
-    grid_data[grid_data<0.01]= np.nan
-    coords = [gridder.xaxis, gridder.yaxis, gridder.zaxis]
+        hklrange = stacks_range(stacks)
+
+    g = make_gridder(gridder, h_n, k_n, l_n, hklrange, dtype)
+    for scan_num, (imgs, qx, qy, qz) in zip(scan_list or [None] * len(stacks), stacks):
+        with stage('select', scan_num, len(imgs)):
+            flag = imgs>0
+            points = qx[flag], qy[flag], qz[flag], imgs[flag]
+        if flag.any():
+            with stage('grid', scan_num, len(imgs)):
+                g(*points)
+        del flag, points
+
+    grid_data = normalize_grid(*gridder_sums(g), gridder)
+    coords = [g.xaxis, g.yaxis, g.zaxis]
     if return_imgs:
+        imgs, qx, qy, qz = [np.concatenate([stack[i] for stack in stacks]) for i in range(4)]
         return grid_data, coords, imgs, qx, qy, qz
     else:
         return grid_data, coords
 
+def stacks_range(stacks):
+    # the h,k,l range [[h_min, h_max], [k_min, k_max], [l_min, l_max]] of loaded (imgs, qx, qy, qz) stacks
+    return [[min(np.min(stack[i]) for stack in stacks), max(np.max(stack[i]) for stack in stacks)]
+            for i in (1, 2, 3)]
+
+def grid_channels(stacks, h_n = 50, k_n = 50, l_n = 50, hklrange = None, gridder = 'numpy', dtype = np.float64,
+            scan_list = None):
+    # Grids several intensity channels measured on the same pixels, e.g. the two polarizations of a
+    # dichroic measurement, computing the voxel of every pixel once for all channels.
+    # stacks: one (channel_imgs, qx, qy, qz) per scan, channel_imgs a sequence of image stacks (one
+    #         per channel) of the shape of qx
+    # gridder: 'numpy' or 'sparse', xu.Gridder3D does not expose its voxel indices
+    # Every channel gets the pixels with intensity > 0 in it, so its sum and count are those of
+    # grid_stacks on that channel alone. Returns the list of (sum, count) of every channel and the coords.
+    if gridder == 'xu':
+        raise ValueError("Multi-channel gridding needs the 'numpy' or 'sparse' gridder.")
+    if hklrange == None:
+        hklrange = stacks_range(stacks)
+    gridders = [make_gridder(gridder, h_n, k_n, l_n, hklrange, dtype) for _ in stacks[0][0]]
+    for scan_num, (channel_imgs, qx, qy, qz) in zip(scan_list or [None] * len(stacks), stacks):
+        with stage('select', scan_num, len(qx)):
+            flags = [imgs>0 for imgs in channel_imgs]
+            hit = np.logical_or.reduce(flags)
+        if hit.any():
+            with stage('grid', scan_num, len(qx)):
+                idx, inside = gridders[0].index(qx[hit], qy[hit], qz[hit])
+                for g, flag, imgs in zip(gridders, flags, channel_imgs):
+                    keep = flag[hit][inside]
+                    g.add(idx[keep], imgs[hit][inside][keep])
+        del flags, hit
+
+    g = gridders[0]
+    return [gridder_sums(g) for g in gridders], [g.xaxis, g.yaxis, g.zaxis]
+
+def sum_diff(grid_a, grid_b):
+    # the sum and difference of two normalized grids (dense or SparseGrid), NaN where either is empty
+    if isinstance(grid_a, SparseGrid):
+        grid_sum = SparseGrid(grid_a.shape, grid_a.dtype, np.nan, grid_a.block)
+        grid_diff = SparseGrid(grid_a.shape, grid_a.dtype, np.nan, grid_a.block)
+        for key in grid_a.blocks.keys() & grid_b.blocks.keys():
+            grid_sum.blocks[key] = grid_a.blocks[key] + grid_b.blocks[key]
+            grid_diff.blocks[key] = grid_a.blocks[key] - grid_b.blocks[key]
+        return grid_sum, grid_diff
+    return grid_a + grid_b, grid_a - grid_b
+
+def rsm_convert_channels(file_name, channels, h_n = 50, k_n = 50, l_n = 50, hklrange = None, gridder = 'numpy',
+            dtype = np.float64, return_sum_diff = False, cache_dir = None, converter = 'xu', detector = None,
+            qconv = None, roi = None, mask = None, binning = None):
+    # rsm_convert of several scan groups measured along the same motor trajectories, e.g. the two
+    # polarizations of a dichroic map, in one pass: h,k,l and the voxel indices are computed once from
+    # the scans of the first group and shared by all groups (see grid_channels).
+    # channels: a list of scan groups, each a scan number or a list of scans, e.g. [[14, 16], [15, 17]]
+    #           for scans 14/15 and 16/17 measured along the same angles. The angles, UB, energy and
+    #           detector of the scans must match those of the first group.
+    # return_sum_diff: also return the sum and difference of the normalized maps of two channels,
+    #                  e.g. for l_slice(diff_map, coords, dichro = True)
+    # Returns the list of (sum, count) volumes of every channel and the coords, and with
+    # return_sum_diff also sum_map, diff_map. A channel map is normalize_grid(sum, count, gridder).
+    # The other options are those of rsm_convert.
+    channels = [[group] if isinstance(group, int) else list(group) for group in channels]
+    if any(len(group) != len(channels[0]) for group in channels):
+        raise ValueError('All channels need the same number of scans.')
+    if return_sum_diff and len(channels) != 2:
+        raise ValueError('return_sum_diff needs exactly two channels.')
+    if roi is not None or mask is not None or binning is not None:
+        detector = detector_with(detector, roi, mask, binning)
+
+    stacks = []
+    for scans in zip(*channels):
+        infos = [load_scan(file_name, scan, detector = detector, qconv = qconv) for scan in scans]
+        key = hkl_cache_key(infos[0])
+        for scan, info in zip(scans[1:], infos[1:]):
+            if hkl_cache_key(info) != key:
+                raise ValueError('Scan ' + str(scan) + ' was not measured along the trajectory of scan '
+                                 + str(scans[0]) + '.')
+        frames = None if hklrange is None else cull_frames(infos[0], hklrange, scans[0])
+        imgs, qx, qy, qz = convert_scan(file_name, scans[0], infos[0], dtype, cache_dir = cache_dir,
+                                        converter = converter, frames = frames)
+        channel_imgs = [imgs] + [load_images(file_name, scan, info['length'] if frames is None else frames,
+                                             I0 = info['I0'], dtype = dtype, detector = info['detector'])
+                                 for scan, info in zip(scans[1:], infos[1:])]
+        stacks.append((channel_imgs, qx, qy, qz))
+
+    grids, coords = grid_channels(stacks, h_n, k_n, l_n, hklrange, gridder, dtype, channels[0])
+    if return_sum_diff:
+        return (grids, coords) + sum_diff(*[normalize_grid(grid_sum, grid_count, gridder)
+                                            for grid_sum, grid_count in grids])
+    return grids, coords
+
+def frame_converter(info, cache_dir = None, max_memory = 2**30, converter = 'xu', dtype = np.float64):
+    # Returns a function giving the h,k,l coordinates of a list of frames of a scan loaded with
+    # load_scan, read from the on-disk cache if cache_dir is given, converted on the fly otherwise.
+    if cache_dir:
+        hkl = cached_hkl(info, None if cache_dir is True else cache_dir, max_memory = max_memory,
+                         converter = converter)
+        return lambda frames: hkl[:, frames].astype(dtype, copy=False)
+    return hkl_converter(info, converter, dtype)
+
+def scan_range(file_name, scan_num, max_memory = 2**30, cache_dir = None, converter = 'xu',
+            detector = None, qconv = None):
+    # The h,k,l range covered by a scan, computed chunk by chunk from the q coordinates only.
+    # Returns [[h_min, h_max], [k_min, k_max], [l_min, l_max]].
+    info = load_scan(file_name, scan_num, detector = detector, qconv = qconv)
+    convert = frame_converter(info, cache_dir, max_memory, converter)
+    lo = np.full(3, np.inf)
+    hi = np.full(3, -np.inf)
+    for frames in chunk_frames(info['length'], max_memory, info['detector']):
+        with stage('convert', scan_num, len(frames)):
+            hkl = convert(frames)
+        for i, q in enumerate(hkl):
+            lo[i] = min(lo[i], np.min(q))
+            hi[i] = max(hi[i], np.max(q))
+    return [[lo[i], hi[i]] for i in range(3)]
+
+def scan_chunks(file_name, scan_list, max_memory = 2**30, dtype = np.float64, cache_dir = None,
+            converter = 'xu', detector = None, qconv = None, hklrange = None):
+    # Yields the h, k, l coordinates and intensities (qx, qy, qz, imgs) of the pixels with
+    # intensity > 0 of the scans, one chunk of frames within max_memory at a time.
+    # hklrange: if given, the frames whose footprint cannot overlap it are skipped (see frames_in_range)
+    if isinstance(scan_list, int):
+        scan_list = [scan_list]
+    for scan_num in scan_list:
+        info = load_scan(file_name, scan_num, detector = detector, qconv = qconv)
+        convert = frame_converter(info, cache_dir, max_memory, converter, dtype)
+        kept = np.arange(info['length']) if hklrange is None else cull_frames(info, hklrange, scan_num)
+        for frames in chunk_frames(len(kept), max_memory, info['detector']):
+            frames = kept[frames]
+            imgs = load_images(file_name, scan_num, frames, I0 = info['I0'], dtype = dtype,
+                               detector = info['detector'])
+            with stage('convert', scan_num, len(frames)):
+                qx, qy, qz = convert(frames)
+            with stage('select', scan_num, len(frames)):
+                flag = imgs>0
+                points = qx[flag], qy[flag], qz[flag], imgs[flag]
+            del imgs, qx, qy, qz, flag
+            yield points
+            del points
+
+def scans_range(file_name, scan_list, max_memory = 2**30, cache_dir = None, converter = 'xu',
+            detector = None, qconv = None, mapper = map):
+    # The h,k,l range covered by all scans, see scan_range. mapper can be the map of a process pool.
+    ranges = np.array(list(mapper(partial(scan_range, file_name, max_memory = max_memory,
+                                          cache_dir = cache_dir, converter = converter,
+                                          detector = detector, qconv = qconv), scan_list)))
+    return [[ranges[:, i, 0].min(), ranges[:, i, 1].max()] for i in range(3)]
+
+def grid_scans(file_name, scan_list, h_n, k_n, l_n, hklrange, max_memory = 2**30, dtype = np.float64,
+            gridder = 'xu', cache_dir = None, converter = 'xu', detector = None, qconv = None, cull = False):
+    # Streams the scans chunk by chunk into a fixed h_n*k_n*l_n grid over hklrange.
+    # Returns the unnormalized intensity sum and the number of pixels of every voxel,
+    # partial results of different scans on the same grid can simply be added.
+    # cull: skip the frames that cannot overlap hklrange
+    g = make_gridder(gridder, h_n, k_n, l_n, hklrange, dtype)
+    for qx, qy, qz, data in scan_chunks(file_name, scan_list, max_memory, dtype, cache_dir, converter,
+                                        detector, qconv, hklrange if cull else None):
+        with stage('grid'):
+            g(qx, qy, qz, data)
+        del qx, qy, qz, data
+    return gridder_sums(g)
+
+def rsm_convert_chunked(file_name, scan_list, h_n = 50, k_n = 50, l_n = 50, hklrange = None,
+            max_memory = 2**30, n_workers = None, gridder = 'xu', dtype = np.float64, cache_dir = None,
+            converter = 'xu', detector = None, qconv = None):
+    # Same result as rsm_convert, but every scan is streamed in chunks of frames: a chunk is loaded,
+    # converted to h,k,l, added to the running sums of the grid and released.
+    # max_memory: memory budget in bytes for one chunk (per worker)
+    # n_workers: number of processes. Every scan is gridded by one worker into partial sum and
+    #            count volumes on the common grid, which are merged here.
+    if isinstance(scan_list, int):
+        scan_list = [scan_list]
 
+    pool = ProcessPoolExecutor(max_workers=n_workers) if n_workers else None
+    mapper = pool.map if pool else map
+    try:
+        # a given hklrange can leave out whole frames, the range of the data cannot
+        cull = hklrange is not None
+        if hklrange == None:
+            # cheap first pass over the q coordinates only, so that all scans share one grid
+            hklrange = scans_range(file_name, scan_list, max_memory, cache_dir, converter, detector,
+                                   qconv, mapper)
+
+        grid = partial(grid_scans, file_name, h_n = h_n, k_n = k_n, l_n = l_n, hklrange = hklrange,
+                       max_memory = max_memory, dtype = dtype, gridder = gridder, cache_dir = cache_dir,
+                       converter = converter, detector = detector, qconv = qconv, cull = cull)
+        if pool:
+            partials = pool.map(grid, [[scan_num] for scan_num in scan_list])
+            grid_sum, grid_count = next(partials)
+            for partial_sum, partial_count in partials:
+                grid_sum += partial_sum
+                grid_count += partial_count
+        else:
+            grid_sum, grid_count = grid(scan_list)
+    finally:
+        if pool:
+            pool.shutdown()
+
+    grid_data = normalize_grid(grid_sum, grid_count, gridder)
+    coords = [xu.gridder.axis(*hklrange[0], h_n), xu.gridder.axis(*hklrange[1], k_n),
+              xu.gridder.axis(*hklrange[2], l_n)]
+    return grid_data, coords
+
+
+
+class ProjectionGridder:
+    # Bins h,k,l points straight into a 1D line or 2D plane, with the binning of NumpyGridder3D along
+    # the kept axes and all points inside the window of the other axes summed across them.
+    # axes: the kept axes, e.g. 'l' for a line along L or 'hk' for an HK plane
+    # shape: number of bins along every kept axis
+    # hklrange: [[h_min, h_max], [k_min, k_max], [l_min, l_max]], the bin range of the kept axes and
+    #           the integration window of the others, None for no limit
+    def __init__(self, axes, shape, hklrange, dtype = np.float64):
+        self.axes = ['hkl'.index(a) for a in axes]
+        self.shape = tuple(int(n) for n in np.atleast_1d(shape))
+        if len(self.shape) != len(self.axes):
+            raise ValueError('One number of bins is needed for every axis of ' + repr(axes))
+        self.hklrange = [None if r is None else [float(r[0]), float(r[1])] for r in hklrange]
+        if any(self.hklrange[a] is None for a in self.axes):
+            raise ValueError('The range of the binned axes is needed.')
+        self.dtype = np.dtype(dtype)
+        self.sum = np.zeros(self.shape, dtype=self.dtype)
+        self.count = np.zeros(self.shape, dtype=np.int64)
+
+    @property
+    def coords(self):
+        return [xu.gridder.axis(*self.hklrange[a], n) for a, n in zip(self.axes, self.shape)]
+
+    def __call__(self, qx, qy, qz, data):
+        q = [np.ravel(qx), np.ravel(qy), np.ravel(qz)]
+        inside = np.ones(q[0].shape, dtype=bool)
+        for a_range, a in zip(self.hklrange, q):
+            if a_range is not None:
+                inside &= a >= a_range[0]
+                inside &= a <= a_range[1]
+        idx = 0
+        for a, n in zip(self.axes, self.shape):
+            a_min, a_max = self.hklrange[a]
+            f = (q[a][inside] - a_min) / xu.gridder.delta(a_min, a_max, n)
+            idx = idx * n + np.rint(f, out=f).astype(np.intp)
+        self.sum += np.bincount(idx, weights=np.ravel(data)[inside], minlength=self.sum.size).reshape(self.shape)
+        self.count += np.bincount(idx, minlength=self.count.size).reshape(self.shape)
+
+    @property
+    def data(self):
+        # mean intensity of every bin, NaN where there is no hit
+        return normalize_grid(self.sum, self.count, 'numpy')
+
+def rsm_project(file_name, scan_list, axes, shape, hklrange = None, max_memory = 2**30, dtype = np.float64,
+            cache_dir = None, converter = 'xu', detector = None, qconv = None, roi = None, mask = None,
+            binning = None):
+    # A line cut or plane of the map binned straight from the pixels, without a 3D grid: the frames
+    # are streamed in chunks of max_memory bytes and only the len(axes)-dimensional bins are kept,
+    # so the resolution is only limited by the number of bins (see ProjectionGridder).
+    # axes, shape: the kept axes ('h', 'k', 'l', 'hk', 'hl', 'kl'...) and their numbers of bins
+    # hklrange: [[h_min, h_max], [k_min, k_max], [l_min, l_max]], the bin range of the kept axes
+    #           (None for the range of the data, found in an extra pass over h,k,l) and the
+    #           integration window of the others (None to sum over the whole data, a projection).
+    #           Frames whose footprint cannot overlap it are skipped (see frames_in_range).
+    # Every bin holds the mean intensity of the pixels falling into it, NaN where there are none,
+    # like a voxel of rsm_convert stretched over the window. The other options are those of rsm_convert.
+    # Returns data, coords with the axes of the kept dimensions.
+    if roi is not None or mask is not None or binning is not None:
+        detector = detector_with(detector, roi, mask, binning)
+    hklrange = [None] * 3 if hklrange is None else list(hklrange)
+    if any(hklrange['hkl'.index(a)] is None for a in axes):
+        data_range = scans_range(file_name, [scan_list] if isinstance(scan_list, int) else scan_list,
+                                 max_memory, cache_dir, converter, detector, qconv)
+        hklrange = [data_range[i] if r is None and 'hkl'[i] in axes else r for i, r in enumerate(hklrange)]
+    g = ProjectionGridder(axes, shape, hklrange, dtype)
+    # the frames can be culled with the window, unbounded axes included
+    cull = None if all(r is None for r in hklrange) else [[-np.inf, np.inf] if r is None else r for r in hklrange]
+    for qx, qy, qz, data in scan_chunks(file_name, scan_list, max_memory, dtype, cache_dir, converter,
+                                        detector, qconv, cull):
+        with stage('grid'):
+            g(qx, qy, qz, data)
+        del qx, qy, qz, data
+    return g.data, g.coords
+
+def rsm_line(file_name, scan_list, axis = 'l', n = 200, hklrange = None, **kwargs):
+    # A 1D cut along axis ('h', 'k' or 'l') with n bins, integrated over the window of hklrange across
+    # it, e.g. rsm_line('data', [14], 'l', 500, [[-0.01, 0.01], [-0.01, 0.01], [3.8, 4.2]]).
+    # See rsm_project for the options. Returns data, l (the axis).
+    data, coords = rsm_project(file_name, scan_list, axis, n, hklrange, **kwargs)
+    return data, coords[0]
+
+def rsm_plane(file_name, scan_list, axes = 'hk', shape = (200, 200), hklrange = None, **kwargs):
+    # A 2D plane of axes ('hk', 'hl' or 'kl') with shape bins, integrated over the window of hklrange
+    # along the third axis (a projection if its range is None). See rsm_project for the options.
+    # Returns data, coords of the two axes.
+    return rsm_project(file_name, scan_list, axes, shape, hklrange, **kwargs)
+
+
+class OctreeGrid:
+    # An adaptive grid over hklrange that refines around Bragg peaks. The voxels of a coarse nx*ny*nz
+    # base grid (level 0) are split into 2*2*2 children where enough pixels with enough intensity
+    # fall in, level by level down to max_depth, the background stays coarse. Level d has the
+    # resolution of a (nx, ny, nz) * 2**d grid, the base voxels are centred on the axis points like
+    # in NumpyGridder3D and every child lies inside its parent.
+    # The grid is filled in two passes over the data: calls accumulate the base grid until refine()
+    # selects the base voxels to split, then calls accumulate all finer levels below these voxels
+    # only (in SparseGrid blocks) until finish() keeps the leaf voxels of every level.
+    # resample() gives a dense array of any sub-box for the slice viewers and save_vtk.
+    # max_depth: number of refinement levels
+    # min_count: minimum number of pixels in a voxel to split it
+    # min_intensity: minimum mean intensity of a voxel to split it, by default the 90th percentile
+    #                of the non-empty base voxels
+    def __init__(self, hklrange, nx, ny, nz, max_depth = 3, min_count = 64, min_intensity = None,
+                 dtype = np.float64):
+        self.hklrange = [[float(lo), float(hi)] for lo, hi in hklrange]
+        self.shape = (nx, ny, nz)
+        self.max_depth = max_depth
+        self.min_count = min_count
+        self.min_intensity = min_intensity
+        self.dtype = np.dtype(dtype)
+        self.base = NumpyGridder3D(nx, ny, nz, dtype)
+        self.split = None
+        self.levels = None
+        self.leaves = None
+
+    @property
+    def coords(self):
+        # axes of the base grid
+        return [xu.gridder.axis(lo, hi, n) for (lo, hi), n in zip(self.hklrange, self.shape)]
+
+    @property
+    def n_leaves(self):
+        # number of leaf voxels on every level
+        return [len(keys) for keys, grid_sum, grid_count in self.leaves]
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for leaf in self.leaves for a in leaf)
+
+    def level_shape(self, depth):
+        return tuple(n * 2**depth for n in self.shape)
+
+    def axis_index(self, a, axis):
+        # Index of the coordinates a along an axis on the finest level, -1 outside the range.
+        # A base voxel covers +-delta/2 around its axis point, so with f the position in base voxels
+        # the index is floor((f + 1/2) * 2**max_depth).
+        lo, hi = self.hklrange[axis]
+        n = self.shape[axis]
+        f = (np.asarray(a, dtype=np.float64) - lo) / xu.gridder.delta(lo, hi, n)
+        i = np.floor((f + 0.5) * 2**self.max_depth)
+        i[~((a >= lo) & (a <= hi))] = -1
+        return np.minimum(i, n * 2**self.max_depth - 1).astype(np.intp)
+
+    def index(self, x, y, z):
+        # the finest level indices (i, j, k) of the points inside the range and the mask of these points
+        ijk = [self.axis_index(np.ravel(a), axis) for axis, a in enumerate((x, y, z))]
+        inside = (ijk[0] >= 0) & (ijk[1] >= 0) & (ijk[2] >= 0)
+        return [i[inside] for i in ijk], inside
+
+    def level_index(self, ijk, depth):
+        # linear voxel indices on a level of finest level indices
+        return np.ravel_multi_index([i >> (self.max_depth - depth) for i in ijk], self.level_shape(depth))
+
+    def splits(self, grid_sum, grid_count):
+        # which of the voxels with these sums and counts are split
+        return (grid_count >= self.min_count) & (grid_sum >= self.min_intensity * grid_count)
+
+    def __call__(self, x, y, z, data):
+        ijk, inside = self.index(x, y, z)
+        data = np.ravel(data)[inside]
+        if self.split is None:
+            self.base.add(self.level_index(ijk, 0), data)
+            return
+        sel = self.split.reshape(-1)[self.level_index(ijk, 0)]
+        ijk, data = [i[sel] for i in ijk], data[sel]
+        for depth, g in enumerate(self.levels, 1):
+            g.add(self.level_index(ijk, depth), data)
+
+    def refine(self):
+        # ends the base pass: selects the base voxels to split
+        grid_sum, grid_count = self.base.sum, self.base.count
+        if self.min_intensity is None:
+            hit = grid_count > 0
+            self.min_intensity = np.percentile(grid_sum[hit] / grid_count[hit], 90) if hit.any() else np.inf
+        self.split = self.splits(grid_sum, grid_count) & (self.max_depth > 0)
+        self.levels = [SparseGridder3D(*self.level_shape(depth), dtype = self.dtype)
+                       for depth in range(1, self.max_depth + 1)]
+
+    def finish(self):
+        # Ends the refinement pass: keeps the leaf voxels of every level as sorted linear indices
+        # with their intensity sum and count, and releases the accumulators.
+        grid_count = self.base.count.reshape(-1)
+        keys = np.flatnonzero((grid_count > 0) & ~self.split.reshape(-1))
+        self.leaves = [(keys, self.base.sum.reshape(-1)[keys], grid_count[keys])]
+        split = np.flatnonzero(self.split)
+        for depth, g in enumerate(self.levels, 1):
+            keys = g.count.nonzero()
+            # below a split base voxel all levels were accumulated, keep the children of split voxels
+            parents = np.ravel_multi_index([i >> 1 for i in np.unravel_index(keys, self.level_shape(depth))],
+                                           self.level_shape(depth - 1))
+            keys = keys[np.isin(parents, split)]
+            grid_sum, grid_count = g.sum.take(keys), g.count.take(keys)
+            is_split = self.splits(grid_sum, grid_count) & (depth < self.max_depth)
+            split = keys[is_split]
+            self.leaves.append((keys[~is_split], grid_sum[~is_split], grid_count[~is_split]))
+        self.base = self.split = self.levels = None
+
+    def resample(self, hrange = None, krange = None, lrange = None, shape = None):
+        # Dense mean intensity of the sub-box hrange*krange*lrange (default the full range) on shape
+        # points per axis. By default the points are the centres of the finest level voxels inside
+        # the sub-box, so that every finest voxel is sampled exactly once (points on the voxel
+        # boundaries would fall into either neighbour with the rounding). Every point takes the value
+        # of the leaf containing it, NaN where no pixel fell. Returns (grid_data, coords) like rsm_convert.
+        box = [self.hklrange[axis] if r is None else r for axis, r in enumerate((hrange, krange, lrange))]
+        if shape is None:
+            coords = []
+            for axis, (lo, hi) in enumerate(box):
+                a_lo, a_hi = self.hklrange[axis]
+                step = xu.gridder.delta(a_lo, a_hi, self.shape[axis]) / 2**self.max_depth
+                # the base voxel 0 starts half a base voxel below a_lo
+                c = a_lo + (np.arange(self.level_shape(self.max_depth)[axis]) + 0.5 - 2**self.max_depth / 2) * step
+                coords.append(c[(c >= lo) & (c <= hi)])
+            shape = [len(c) for c in coords]
+        else:
+            coords = [xu.gridder.axis(lo, hi, n) for (lo, hi), n in zip(box, shape)]
+        ijk = [self.axis_index(c, axis) for axis, c in enumerate(coords)]
+        sel = np.ix_(*[np.flatnonzero(i >= 0) for i in ijk])
+        ijk = [i[i >= 0] for i in ijk]
+        values = np.full([len(i) for i in ijk], np.nan, dtype=self.dtype)
+        for depth, (keys, grid_sum, grid_count) in enumerate(self.leaves):
+            if not len(keys):
+                continue
+            n = self.level_shape(depth)
+            i, j, k = [a >> (self.max_depth - depth) for a in ijk]
+            idx = (i[:, None, None] * n[1] + j[None, :, None]) * n[2] + k[None, None, :]
+            pos = np.minimum(np.searchsorted(keys, idx), len(keys) - 1)
+            hit = keys[pos] == idx
+            values[hit] = grid_sum[pos[hit]] / grid_count[pos[hit]]
+        grid_data = np.full(shape, np.nan, dtype=self.dtype)
+        grid_data[sel] = values
+        return grid_data, coords
 
-
-def visualize_det(imgs, qx, qy, qz, cscale = [50, 99], downscale = 20):
+def rsm_convert_adaptive(file_name, scan_list, h_n = 50, k_n = 50, l_n = 50, hklrange = None,
+            max_depth = 3, min_count = 64, min_intensity = None, max_memory = 2**30, dtype = np.float64,
+            cache_dir = None, converter = 'xu', detector = None, qconv = None):
+    # Adaptive version of rsm_convert: h_n*k_n*l_n is the coarse base grid, of which the voxels around
+    # peaks are refined up to max_depth times, see OctreeGrid. The scans are streamed twice in
+    # chunks of max_memory bytes (plus a pass over h,k,l only without hklrange), cache_dir avoids
+    # converting the angles every time. Returns the OctreeGrid, e.g.
+    #   tree = rsm_convert_adaptive('your_file', [14, 15], max_depth = 3)
+    #   grid_data, coords = tree.resample([0.9, 1.1], [-0.1, 0.1], [0.9, 1.1])
+    if isinstance(scan_list, int):
+        scan_list = [scan_list]
+    cull = hklrange is not None
+    if hklrange == None:
+        hklrange = scans_range(file_name, scan_list, max_memory, cache_dir, converter, detector, qconv)
+    tree = OctreeGrid(hklrange, h_n, k_n, l_n, max_depth, min_count, min_intensity, dtype)
+    chunks = partial(scan_chunks, file_name, scan_list, max_memory, dtype, cache_dir, converter,
+                     detector, qconv, hklrange if cull else None)
+    for qx, qy, qz, data in chunks():
+        with stage('grid'):
+            tree(qx, qy, qz, data)
+        del qx, qy, qz, data
+    tree.refine()
+    for qx, qy, qz, data in chunks():
+        with stage('grid'):
+            tree(qx, qy, qz, data)
+        del qx, qy, qz, data
+    tree.finish()
+    return tree
+
+class GriddingPlan:
+    # The voxel of every detector pixel of a scan geometry on a fixed h_n*k_n*l_n grid over hklrange,
+    # for series of scans repeated along the same trajectory (e.g. temperature or field series).
+    # The plan is built once from one scan; gridding another scan with the same motor positions, UB,
+    # energy and detector geometry (the key of the h,k,l cache, see hkl_cache_key) is then only
+    # loading its images and one np.bincount, without converting or indexing anything.
+    # The plan is saved to and loaded from HDF5 files, so it can be reused in later sessions.
+    #     plan = GriddingPlan.build('data', 14, 100, 100, 100)
+    #     plan.save('eta_scan.plan.h5')
+    #     grid_data, coords = GriddingPlan.load('eta_scan.plan.h5').rsm_convert('data', 15)
+    # key: hkl_cache_key of the scan geometry
+    # index: (frames, Nch1, Nch2) linear voxel index (C order) of every pixel, -1 outside the grid
+    # frames: the frames of the scans the plan covers (all, or those that can overlap hklrange)
+    # weights: optional weights multiplied with the intensities, broadcast to index
+    def __init__(self, key, shape, hklrange, index, frames, weights = None):
+        self.key = key
+        self.shape = tuple(int(n) for n in shape)
+        self.hklrange = [[float(lo), float(hi)] for lo, hi in hklrange]
+        self.index = index
+        self.frames = np.asarray(frames, dtype=int)
+        self.weights = weights
+
+    @classmethod
+    def build(cls, file_name, scan_num, h_n = 50, k_n = 50, l_n = 50, hklrange = None, weights = None,
+              max_memory = 2**30, cache_dir = None, converter = 'xu', detector = None, qconv = None):
+        # The plan of the geometry of a scan. Without hklrange the grid spans the h,k,l range of the
+        # scan, as in rsm_convert, otherwise only the frames that can overlap it are kept.
+        # weights: per pixel (Nch1, Nch2) or per frame and pixel weights of the intensities
+        # The scan is converted chunk by chunk within max_memory, cache_dir, converter, detector and
+        # qconv are those of rsm_convert.
+        info = load_scan(file_name, scan_num, detector = detector, qconv = qconv)
+        if hklrange is None:
+            frames = np.arange(info['length'])
+            hklrange = scan_range(file_name, scan_num, max_memory, cache_dir, converter, detector, qconv)
+        else:
+            frames = cull_frames(info, hklrange, scan_num)
+        g = make_gridder('numpy', h_n, k_n, l_n, hklrange)
+        geometry = detector_geometry(info['detector'])
+        index = np.empty((len(frames), geometry['Nch1'], geometry['Nch2']),
+                         dtype=np.int32 if h_n * k_n * l_n < 2**31 else np.int64)
+        convert = frame_converter(info, cache_dir, max_memory, converter)
+        for chunk in chunk_frames(len(frames), max_memory, info['detector']):
+            with stage('convert', scan_num, len(chunk)):
+                qx, qy, qz = convert(frames[chunk])
+            with stage('grid', scan_num, len(chunk)):
+                idx, inside = g.index(qx, qy, qz)
+                voxels = np.full(qx.size, -1, dtype=index.dtype)
+                voxels[inside] = idx
+                index[chunk] = voxels.reshape(qx.shape)
+            del qx, qy, qz, idx, voxels
+        return cls(hkl_cache_key(info), (h_n, k_n, l_n), hklrange, index, frames, weights)
+
+    @property
+    def coords(self):
+        return [xu.gridder.axis(lo, hi, n) for (lo, hi), n in zip(self.hklrange, self.shape)]
+
+    @property
+    def nbytes(self):
+        return self.index.nbytes + (0 if self.weights is None else np.asarray(self.weights).nbytes)
+
+    def matches(self, info):
+        # whether a scan loaded with load_scan has the geometry of the plan
+        return hkl_cache_key(info) == self.key
+
+    def grid(self, imgs, frames = slice(None)):
+        # The intensity sum and hit count volumes of images of the plan frames (default all of them),
+        # counting the pixels with intensity > 0 like the gridders of rsm_convert.
+        index = self.index[frames]
+        flag = (imgs > 0) & (index >= 0)
+        data = imgs[flag]
+        if self.weights is not None:
+            data = data * np.broadcast_to(self.weights, self.index.shape)[frames][flag]
+        size = int(np.prod(self.shape))
+        grid_sum = np.bincount(index[flag], weights=data, minlength=size).reshape(self.shape)
+        grid_count = np.bincount(index[flag], minlength=size).reshape(self.shape)
+        return grid_sum, grid_count
+
+    def grid_scans(self, file_name, scan_list, max_memory = 2**30, dtype = np.float64, detector = None,
+                   qconv = None):
+        # The summed intensity and hit count volumes of scans with the geometry of the plan, loaded
+        # chunk by chunk within max_memory. Raises a ValueError for a scan of another geometry.
+        if isinstance(scan_list, int):
+            scan_list = [scan_list]
+        grid_sum = np.zeros(self.shape)
+        grid_count = np.zeros(self.shape, dtype=np.int64)
+        for scan_num in scan_list:
+            info = load_scan(file_name, scan_num, detector = detector, qconv = qconv)
+            if not self.matches(info):
+                raise ValueError('Scan ' + str(scan_num) + ' does not have the geometry of the gridding plan.')
+            for chunk in chunk_frames(len(self.frames), max_memory, info['detector']):
+                imgs = load_images(file_name, scan_num, self.frames[chunk], I0 = info['I0'], dtype = dtype,
+                                   detector = info['detector'])
+                with stage('grid', scan_num, len(chunk)):
+                    chunk_sum, chunk_count = self.grid(imgs, chunk)
+                    grid_sum += chunk_sum
+                    grid_count += chunk_count
+                del imgs
+        return grid_sum, grid_count
+
+    def rsm_convert(self, file_name, scan_list, max_memory = 2**30, dtype = np.float64, detector = None,
+                    qconv = None):
+        # rsm_convert of scans with the geometry of the plan on the grid of the plan, with empty
+        # voxels NaN as with gridder = 'numpy'. Returns grid_data, coords.
+        grid_sum, grid_count = self.grid_scans(file_name, scan_list, max_memory, dtype, detector, qconv)
+        return normalize_grid(grid_sum, grid_count, 'numpy'), self.coords
+
+    def save(self, path):
+        # writes the plan to an HDF5 file
+        with h5py.File(path, 'w') as f:
+            f.create_dataset('index', data=self.index, chunks=True, compression='gzip', shuffle=True)
+            f.create_dataset('frames', data=self.frames)
+            if self.weights is not None:
+                f.create_dataset('weights', data=np.asarray(self.weights, dtype=np.float32))
+            f.attrs['key'] = self.key
+            f.attrs['shape'] = self.shape
+            f.attrs['hklrange'] = np.asarray(self.hklrange, dtype=float)
+        return path
+
+    @classmethod
+    def load(cls, path):
+        # reads a plan written by save
+        with h5py.File(path, 'r') as f:
+            weights = f['weights'][:] if 'weights' in f else None
+            return cls(f.attrs['key'], f.attrs['shape'], f.attrs['hklrange'], f['index'][:], f['frames'][:], weights)
+
+def hit_box(grid_count):
+    # The slices of the bounding box of the voxels with hits of a dense or SparseGrid count volume
+    # (for a SparseGrid, of its allocated blocks), empty slices without any hit.
+    if isinstance(grid_count, SparseGrid):
+        return grid_count.box()
+    hit = [np.flatnonzero(np.any(grid_count, axis=axes)) for axes in [(1, 2), (0, 2), (0, 1)]]
+    return tuple(slice(i[0], i[-1] + 1) if len(i) else slice(0, 0) for i in hit)
+
+class GridFile:
+    # Base of the HDF5 files holding maps on one fixed h_n*k_n*l_n grid over hklrange (RSMStore,
+    # RSMSeries): opens or creates the file with the grid axes 'h', 'k', 'l' and reads sub-boxes.
+    # path: the .h5 file, opened if it exists, created otherwise with the datasets of create()
+    # hklrange, h_n, k_n, l_n: the grid of a new file
+    # chunks: HDF5 chunk shape of a volume
+    # dtype: dtype of the volumes
+    # mode: h5py mode of an existing file, 'r' opens it read-only
+    def __init__(self, path, hklrange = None, h_n = 50, k_n = 50, l_n = 50, chunks = (32, 32, 32),
+                 dtype = np.float64, mode = 'a'):
+        self.path = path
+        if os.path.isfile(path) or mode == 'r':
+            self.f = h5py.File(path, mode)
+            return
+        if hklrange is None:
+            raise ValueError('hklrange is needed to create a new ' + type(self).__name__ + '.')
+        self.f = h5py.File(path, 'w')
+        shape = (h_n, k_n, l_n)
+        self.create(shape, tuple(min(c, n) for c, n in zip(chunks, shape)), dtype)
+        for name, (a_min, a_max), n in zip('hkl', hklrange, shape):
+            self.f['/'].create_dataset(name, data=xu.gridder.axis(a_min, a_max, n))
+        self.f.attrs['hklrange'] = np.asarray(hklrange, dtype=float)
+
+    def create(self, shape, chunks, dtype):
+        # creates the datasets of a new file
+        raise NotImplementedError
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def shape(self):
+        return tuple(len(self.f[name]) for name in 'hkl')
+
+    @property
+    def hklrange(self):
+        return self.f.attrs['hklrange'].tolist()
+
+    @property
+    def coords(self):
+        return [self.f['h'][:], self.f['k'][:], self.f['l'][:]]
+
+    def box(self, hrange = None, krange = None, lrange = None):
+        # The slices of the voxels inside hrange, krange, lrange ([min, max], default the full axis)
+        # and their h,k,l axes.
+        box = []
+        coords = []
+        for name, a_range in zip('hkl', [hrange, krange, lrange]):
+            axis = self.f[name][:]
+            if a_range is None:
+                box.append(slice(None))
+            else:
+                box.append(slice(np.searchsorted(axis, a_range[0], 'left'),
+                                 np.searchsorted(axis, a_range[1], 'right')))
+            coords.append(axis[box[-1]])
+        return tuple(box), coords
+
+class RSMStore(GridFile):
+    # A reciprocal space map kept in an HDF5 file, to which scans can be added incrementally.
+    # The file holds chunked 'sum' and 'count' volumes on a fixed h_n*k_n*l_n grid over hklrange,
+    # the grid axes 'h', 'k', 'l' and the list of merged scans 'scans'. Adding a scan only grids that
+    # scan and adds it to the part of the volumes it hits.
+    # The arguments are those of GridFile, dtype is the dtype of the sum volume.
+    def create(self, shape, chunks, dtype):
+        self.f.create_dataset('sum', shape, dtype=dtype, chunks=chunks, fillvalue=0)
+        self.f.create_dataset('count', shape, dtype=np.int64, chunks=chunks, fillvalue=0)
+        self.f.create_dataset('scans', (0,), dtype=h5py.string_dtype(), maxshape=(None,))
+
+    @property
+    def scans(self):
+        # the merged scans as 'file_name:scan_num'
+        return [scan.decode() if isinstance(scan, bytes) else scan for scan in self.f['scans'][:]]
+
+    def add(self, grid_sum, grid_count, scans = []):
+        # Adds partial sum and count volumes on the grid of the store, and records their scans.
+        # Only the bounding box of the voxels with hits is read and written. The volumes can be
+        # dense or SparseGrid (gridder = 'sparse'), of which only the allocated blocks are read.
+        box = hit_box(grid_count)
+        if all(b.stop > b.start for b in box):
+            self.f['sum'][box] = self.f['sum'][box] + grid_sum[box]
+            self.f['count'][box] = self.f['count'][box] + grid_count[box]
+        n = len(self.f['scans'])
+        self.f['scans'].resize((n + len(scans),))
+        self.f['scans'][n:] = scans
+        self.f.flush()
+
+    def add_scans(self, file_name, scan_list, max_memory = 2**30, n_workers = None, **kwargs):
+        # Grids the scans that are not merged yet onto the grid of the store and adds them.
+        # max_memory, n_workers and the other keyword arguments (gridder, cache_dir, converter,
+        # detector, qconv) are used as in rsm_convert_chunked.
+        # Returns the list of added scans.
+        if isinstance(scan_list, int):
+            scan_list = [scan_list]
+        merged = self.scans
+        new = [scan_num for scan_num in scan_list if file_name + ':' + str(scan_num) not in merged]
+        if not new:
+            return []
+        h_n, k_n, l_n = self.shape
+        grid = partial(grid_scans, file_name, h_n = h_n, k_n = k_n, l_n = l_n, hklrange = self.hklrange,
+                       max_memory = max_memory, cull = True, **kwargs)
+        if n_workers:
+            with ProcessPoolExecutor(max_workers=n_workers) as pool:
+                for scan_num, (grid_sum, grid_count) in zip(new, pool.map(grid, [[scan_num] for scan_num in new])):
+                    self.add(grid_sum, grid_count, [file_name + ':' + str(scan_num)])
+        else:
+            for scan_num in new:
+                self.add(*grid([scan_num]), [file_name + ':' + str(scan_num)])
+        return new
+
+    def read(self, hrange = None, krange = None, lrange = None):
+        # The normalized map, NaN where there is no hit, and its h,k,l axes, like rsm_convert returns.
+        # hrange, krange, lrange: [min, max] to read only the voxels inside, default the full axis
+        box, coords = self.box(hrange, krange, lrange)
+        grid_sum = self.f['sum'][box]
+        grid_count = self.f['count'][box]
+        return normalize_grid(grid_sum, grid_count, 'numpy'), coords
+
+
+class RSMSeries(GridFile):
+    # Maps of a series of scans (one entry per temperature, field, time point...) on one fixed grid,
+    # kept in an HDF5 file as a chunked 4D 'data' array (entry, h, k, l) with the series 'parameter'
+    # and the 'scans' of every entry. An entry is marked in 'done' only once its map is written, so
+    # process() can be run again after an interruption and only grids the entries still missing.
+    #     with RSMSeries('series.h5', hklrange, 100, 100, 100) as series:
+    #         series.process('data', {10: [14, 15], 20: [16, 17], 30: [18, 19]})
+    #         grid_data, coords = series.read(20)
+    # The arguments are those of GridFile (hklrange e.g. from scans_range over all scans), chunks
+    # is the chunk shape of one map and dtype the dtype of the maps.
+    def create(self, shape, chunks, dtype):
+        self.f.create_dataset('data', (0,) + shape, dtype=dtype, chunks=(1,) + chunks, maxshape=(None,) + shape,
+                              fillvalue=np.nan)
+        self.f.create_dataset('parameter', (0,), dtype=float, maxshape=(None,))
+        self.f.create_dataset('scans', (0,), dtype=h5py.string_dtype(), maxshape=(None,))
+        self.f.create_dataset('done', (0,), dtype=bool, maxshape=(None,))
+
+    def __len__(self):
+        return len(self.f['parameter'])
+
+    @property
+    def parameters(self):
+        return self.f['parameter'][:]
+
+    @property
+    def done(self):
+        # the parameters of the finished entries
+        return self.parameters[self.f['done'][:]]
+
+    def entry(self, parameter, scans):
+        # The index of the entry of parameter, added if new. scans ('file_name:scan,scan,...') must be
+        # those the entry was created with.
+        found = np.flatnonzero(self.parameters == parameter)
+        if len(found):
+            recorded = self.f['scans'][found[0]]
+            recorded = recorded.decode() if isinstance(recorded, bytes) else recorded
+            if recorded != scans:
+                raise ValueError('Parameter ' + str(parameter) + ' was processed from ' + recorded
+                                 + ', not from ' + scans + '.')
+            return int(found[0])
+        i = len(self)
+        for name in ['data', 'parameter', 'scans', 'done']:
+            self.f[name].resize(i + 1, axis=0)
+        self.f['parameter'][i] = parameter
+        self.f['scans'][i] = scans
+        self.f['done'][i] = False
+        return i
+
+    def write(self, i, grid_sum, grid_count):
+        # Writes the normalized map of entry i and marks it done. Only the bounding box of the voxels
+        # with hits is written, the rest of the map keeps the NaN fill value. The volumes can be dense
+        # or SparseGrid (gridder = 'sparse').
+        box = hit_box(grid_count)
+        if all(b.stop > b.start for b in box):
+            self.f['data'][(i,) + box] = normalize_grid(grid_sum[box], grid_count[box], 'numpy')
+        self.f.flush()
+        self.f['done'][i] = True
+        self.f.flush()
+
+    def process(self, file_name, series, max_memory = 2**30, n_workers = None, **kwargs):
+        # Grids every entry of series, {parameter: scan number or list of scans}, that is not done
+        # yet onto the grid of the series. The entries are gridded in parallel on n_workers processes
+        # (default all cores, 1 grids them here one after the other) and every map is written as
+        # soon as it is finished. max_memory and the other keyword arguments (gridder, cache_dir,
+        # converter, detector, qconv, dtype) are used as in rsm_convert_chunked.
+        # An entry that fails does not stop the others: all other maps are still written, then a
+        # RuntimeError lists the failed parameters, which a later call tries again.
+        # Returns the list of parameters gridded by this call.
+        todo = []
+        for parameter, scan_list in series.items():
+            scan_list = [scan_list] if isinstance(scan_list, int) else list(scan_list)
+            i = self.entry(parameter, file_name + ':' + ','.join(str(scan_num) for scan_num in scan_list))
+            if not self.f['done'][i]:
+                todo.append((i, parameter, scan_list))
+        if not todo:
+            return []
+        print('Series: ' + str(len(todo)) + ' of ' + str(len(series)) + ' entries to grid')
+
+        h_n, k_n, l_n = self.shape
+        grid = partial(grid_scans, file_name, h_n = h_n, k_n = k_n, l_n = l_n, hklrange = self.hklrange,
+                       max_memory = max_memory, cull = True, **kwargs)
+        done = []
+        failed = []
+
+        def finish(n, i, parameter, result):
+            # writes the map of an entry, or records why it failed
+            try:
+                self.write(i, *result())
+            except Exception as error:
+                failed.append((parameter, error))
+                print('Series: parameter ' + str(parameter) + ' failed: ' + repr(error))
+                return
+            done.append(parameter)
+            print('Series: parameter ' + str(parameter) + ' done (' + str(n + 1) + ' of ' + str(len(todo)) + ')')
+
+        if n_workers == 1:
+            for n, (i, parameter, scan_list) in enumerate(todo):
+                finish(n, i, parameter, partial(grid, scan_list))
+        else:
+            with ProcessPoolExecutor(max_workers=n_workers) as pool:
+                futures = {pool.submit(grid, scan_list): (i, parameter) for i, parameter, scan_list in todo}
+                for n, future in enumerate(as_completed(futures)):
+                    finish(n, *futures[future], future.result)
+        if failed:
+            raise RuntimeError('Series: ' + str(len(failed)) + ' of ' + str(len(todo)) + ' entries failed, '
+                               + ', '.join(str(parameter) + ' (' + repr(error) + ')' for parameter, error in failed))
+        return done
+
+    def read(self, parameter, hrange = None, krange = None, lrange = None):
+        # The map of a parameter and its h,k,l axes, like rsm_convert returns, NaN where there is no
+        # hit or the entry is not done. hrange, krange, lrange: [min, max] to read only the voxels inside
+        found = np.flatnonzero(self.parameters == parameter)
+        if not len(found):
+            raise KeyError('No entry for parameter ' + str(parameter))
+        box, coords = self.box(hrange, krange, lrange)
+        return self.f['data'][(int(found[0]),) + box], coords
+
+
+class LiveRSM:
+    # Builds the map of a scan while it is measured. Every call of poll() reads the growing spec file
+    # again, and converts and grids the frames whose scan point and tif file have arrived since the
+    # last call into a fixed grid. grid_data() gives the current partial map at any time.
+    # The frames are gridded divided by the raw I0 and the whole map is scaled by the mean I0 of the
+    # points so far, so the finished map is the same as rsm_convert(..., gridder = 'numpy') with the
+    # same converter.
+    # hklrange, h_n, k_n, l_n: the fixed grid
+    # detector, qconv: detector and diffractometer geometry, default DETECTOR and QCONV
+    # converter: 'numpy' for the fast QEngine (default), 'xu' for hxrd.Ang2Q.area as in rsm_convert
+    # dtype: dtype of the images, q coordinates and grid
+    def __init__(self, file_name, scan_num, hklrange, h_n = 50, k_n = 50, l_n = 50,
+                 detector = None, qconv = None, dtype = np.float64, converter = 'numpy'):
+        self.file_name = file_name
+        self.scan_num = scan_num
+        self.detector = DETECTOR if detector is None else detector
+        self.qconv = QCONV if qconv is None else qconv
+        self.dtype = dtype
+        self.converter = converter
+        self.hklrange = hklrange
+        self.gridder = make_gridder('numpy', h_n, k_n, l_n, hklrange, dtype)
+        self.frames_done = 0
+        # frames outside hklrange, skipped without decoding
+        self.frames_skipped = 0
+        self.I0_mean = 1.
+
+    def poll(self):
+        # grids the newly arrived frames, returns their number
+        try:
+            info = load_scan(self.file_name, self.scan_num, detector = self.detector, qconv = self.qconv)
+        except KeyError:
+            # the scan has not started yet
+            return 0
+        template = image_path_template(self.file_name, self.scan_num)
+        end = self.frames_done
+        while end < info['length'] and os.path.isfile(template.format(end)):
+            end += 1
+        new = np.arange(self.frames_done, end)
+        if len(new) == 0:
+            return 0
+        frames = frames_in_range(info, self.hklrange, new)
+        try:
+            imgs = load_images(self.file_name, self.scan_num, frames, I0 = info['I0'] * info['I0_mean'],
+                               dtype = self.dtype, detector = self.detector)
+        except (OSError, ValueError):
+            # a tif file is still being written, retry at the next poll
+            return 0
+        if len(frames):
+            with stage('convert', self.scan_num, len(frames)):
+                qx, qy, qz = hkl_converter(info, self.converter, self.dtype)(frames)
+            with stage('select', self.scan_num, len(frames)):
+                flag = imgs>0
+                points = qx[flag], qy[flag], qz[flag], imgs[flag]
+            with stage('grid', self.scan_num, len(frames)):
+                self.gridder(*points)
+        self.frames_done = end
+        self.frames_skipped += len(new) - len(frames)
+        self.I0_mean = info['I0_mean']
+        return len(new)
+
+    def run(self, n_frames = None, interval = 1., timeout = 60., callback = None):
+        # Polls until n_frames frames are gridded, or until nothing arrived for timeout seconds.
+        # callback: called as callback(self) after every poll that gridded new frames
+        last = time.time()
+        while n_frames is None or self.frames_done < n_frames:
+            if self.poll():
+                last = time.time()
+                if callback is not None:
+                    callback(self)
+            elif time.time() - last > timeout:
+                break
+            else:
+                time.sleep(interval)
+        return self.grid_data()
+
+    def grid_data(self):
+        # the current map and its h,k,l axes, like rsm_convert returns
+        grid_sum, grid_count = gridder_sums(self.gridder)
+        grid_data = normalize_grid(grid_sum, grid_count, 'numpy') * self.I0_mean
+        return grid_data, [self.gridder.xaxis, self.gridder.yaxis, self.gridder.zaxis]
+
+
+class Experiment:
+    # A session on one spec file. It keeps the spec file open, owns the detector and diffractometer
+    # geometry, and keeps recently loaded and converted scans in memory, so that repeated calls on
+    # overlapping scan lists only load the new scans.
+    # file_name: the spec file name, as for load_convert
+    # detector: entries replacing the DETECTOR defaults, e.g. dict(cch1 = 190, cch2 = 150, distance = 760)
+    # qconv: entries replacing the QCONV defaults (sampleAxis, detectorAxis, r_i)
+    # max_memory: bytes of converted scans kept in the least recently used cache
+    def __init__(self, file_name, detector = None, qconv = None, max_memory = 2**32):
+        self.file_name = file_name
+        self.detector = dict(DETECTOR, **(detector or {}))
+        self.qconv = dict(QCONV, **(qconv or {}))
+        self.max_memory = max_memory
+        self.sf = silx.io.open(file_name + '.spec')
+        self.scans = {}
+        self.cache = OrderedDict()
+        self.cache_bytes = 0
+
+    def close(self):
+        self.clear_cache()
+        self.sf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def clear_cache(self):
+        self.scans.clear()
+        self.cache.clear()
+        self.cache_bytes = 0
+
+    def scan(self, scan_num):
+        # the spec information of a scan, see load_scan
+        if scan_num not in self.scans:
+            with stage('spec', scan_num):
+                self.scans[scan_num] = load_scan(self.file_name, scan_num, self.sf, self.detector, self.qconv)
+        return self.scans[scan_num]
+
+    def load_convert(self, scan_num, dtype = np.float64, n_threads = None, cache_dir = None, converter = 'xu'):
+        # load_convert with the geometry of the experiment, served from memory when the scan is cached.
+        # The returned arrays are shared with the cache and should not be modified in place.
+        key = (scan_num, np.dtype(dtype).str, cache_dir, converter)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        stack = convert_scan(self.file_name, scan_num, self.scan(scan_num), dtype, n_threads,
+                             cache_dir, converter)
+        # memory-mapped arrays from the h,k,l cache are not counted
+        nbytes = sum(a.nbytes for a in stack if not isinstance(a, np.memmap))
+        if nbytes <= self.max_memory:
+            self.cache[key] = stack
+            self.cache_bytes += nbytes
+            while self.cache_bytes > self.max_memory:
+                _, old = self.cache.popitem(last=False)
+                self.cache_bytes -= sum(a.nbytes for a in old if not isinstance(a, np.memmap))
+        return stack
+
+    def rsm_convert(self, scan_list, h_n = 50, k_n = 50, l_n = 50, return_imgs = False, hklrange = None,
+                max_memory = None, n_workers = None, gridder = 'xu', cache_dir = None, converter = 'xu',
+                dtype = np.float64):
+        # rsm_convert with the geometry of the experiment. The scans are taken from the cache of
+        # the experiment; with max_memory or n_workers they are streamed from disk as in rsm_convert.
+        if max_memory is not None or n_workers is not None:
+            return rsm_convert(self.file_name, scan_list, h_n, k_n, l_n, return_imgs, hklrange, max_memory,
+                               n_workers, gridder, cache_dir, converter, self.detector, self.qconv, dtype = dtype)
+        if isinstance(scan_list, int):
+            scan_list = [scan_list]
+        stacks = [self.load_convert(scan, dtype, cache_dir = cache_dir, converter = converter) for scan in scan_list]
+        return grid_stacks(stacks, h_n, k_n, l_n, hklrange, return_imgs, gridder, scan_list, dtype)
+
+
+def sample_percentile(arr, q, max_samples = 2**20):
+    # np.nanpercentile of arr estimated on at most max_samples values at random positions (seeded, so
+    # the result is reproducible). A fixed stride could alias with the row width of the images and
+    # only sample a few detector columns.
+    flat = np.asarray(arr).reshape(-1)
+    if flat.size <= max_samples:
+        return np.nanpercentile(flat, q)
+    index = np.sort(np.random.default_rng(0).integers(0, flat.size, max_samples))
+    return np.nanpercentile(flat[index], q)
+
+def rebin_frames(arrays, bins, frames = slice(None)):
+    # The selected frames of every (frames, height, width) array averaged over bins x bins blocks
+    # in one pass, as float32 (see rebin).
+    out = []
+    for arr in arrays:
+        _, height, width = np.shape(arr)
+        new_height, new_width = height // bins, width // bins
+        block = np.asarray(arr[frames, :new_height * bins, :new_width * bins], dtype=np.float32)
+        block = block.reshape(len(block), new_height, bins, new_width, bins)
+        out.append(np.nanmean(block, axis=(2, 4), dtype=np.float32))
+    return out
+
+def det_payload(nb_frames, height, width, downscale = 20, stride = 1, max_bytes = None, min_size = 16):
+    # The downscale and frame stride of visualize_det and the size in bytes of the figure arrays.
+    # Every frame sends x, y, z and the image as base64 float32 (4/3 x 4 bytes per value). With
+    # max_bytes, downscale and stride are raised until the payload fits: first the images are
+    # binned down to min_size pixels on the short side, then frames are skipped.
+    def size(bins, stride):
+        frames = len(range(0, nb_frames, stride)) + 1
+        return frames * 4 * (height // bins) * (width // bins) * 16 // 3
+    if max_bytes is not None:
+        max_bins = max(downscale, min(height, width) // min_size)
+        while downscale < max_bins and size(downscale, stride) > max_bytes:
+            downscale += 1
+        while stride < nb_frames and size(downscale, stride) > max_bytes:
+            stride += 1
+    return downscale, stride, size(downscale, stride)
+
+def visualize_det(imgs, qx, qy, qz, cscale = [50, 99], downscale = 20, stride = 1, max_bytes = None,
+                  max_samples = 2**20):
     # This program views the loaded MCP image stack at corresponding hkl position.
     # The slider select the image frame.
+    # downscale: bin the images and h,k,l by downscale x downscale pixels
+    # stride: show every stride-th frame
+    # max_bytes: cap of the size of the figure data, downscale and stride are raised to fit (see det_payload)
+    # max_samples: number of pixels from which the color limits are estimated
+    # The frames are sent as float32.
     h_min,h_max = np.nanmin(qx), np.nanmax(qx)
     k_min,k_max = np.nanmin(qy), np.nanmax(qy)
     l_min,l_max = np.nanmin(qz), np.nanmax(qz)
     hlen = h_max-h_min
     klen = k_max-k_min
     llen = l_max-l_min
-    cmin, cmax = np.nanpercentile(imgs, cscale)
+    cmin, cmax = sample_percentile(imgs, cscale, max_samples)
     
     cmap = 'viridis'
     cmin = 0
 
-    nb_frames = np.shape(imgs)[0]
+    nb_frames, height, width = np.shape(imgs)
+    downscale, stride, nbytes = det_payload(nb_frames, height, width, downscale, stride, max_bytes)
+    if max_bytes is not None:
+        print('visualize_det: downscale {}, every {} frame(s), {:.1f} MB'.format(downscale, stride, nbytes / 1e6))
+    index = range(0, nb_frames, stride)
 
-    imgs = rebin(imgs, downscale)
-    qx = rebin(qx, downscale)
-    qy = rebin(qy, downscale)
-    qz = rebin(qz, downscale)
+    imgs, qx, qy, qz = rebin_frames([imgs, qx, qy, qz], downscale, slice(0, nb_frames, stride))
 
 
 
@@ -170,9 +1975,9 @@ def visualize_det(imgs, qx, qy, qz, cscale = [50, 99], downscale = 20):
         cmin=cmin, cmax=cmax, 
         surfacecolor=imgs[idx]
         ),
-        name=str(idx) # you need to name the frame for the animation to behave properly
+        name=str(frame) # you need to name the frame for the animation to behave properly
         )
-        for idx in range(nb_frames)])
+        for idx, frame in enumerate(index)])
 
     # Add data to be displayed before animation starts
     fig.add_trace(go.Surface(
@@ -200,10 +2005,10 @@ def visualize_det(imgs, qx, qy, qz, cscale = [50, 99], downscale = 20):
                     "steps": [
                         {
                             "args": [[f.name], frame_args(0)],
-                            "label": str(k),
+                            "label": f.name,
                             "method": "animate",
                         }
-                        for k, f in enumerate(fig.frames)
+                        for f in fig.frames
                     ],
                 }
             ]
@@ -248,6 +2053,26 @@ def visualize_det(imgs, qx, qy, qz, cscale = [50, 99], downscale = 20):
     # fig.show()
     return fig
 
+def slice_volume(grid_data, logscale = False, dichro = False, cscale = [50, 99]):
+    # The volume shown by the slice viewers with its color map and color limits.
+    # grid_data can be a dense array or a SparseGrid, of which only the allocated blocks are used
+    # for the percentiles (the other voxels are NaN).
+    if isinstance(grid_data, SparseGrid):
+        volume = grid_data.map(np.log) if logscale else grid_data
+        values = volume.values()
+    else:
+        volume = np.log(grid_data) if logscale else grid_data
+        values = volume
+    if dichro:
+        cmap = 'RdBu'
+        cmin, cmax = np.nanpercentile(abs(values), cscale)
+        cmin = -cmax
+    else:
+        cmin, cmax = np.nanpercentile(values, cscale)
+        cmap = 'viridis'
+        cmin = 0
+    return volume, cmap, cmin, cmax
+
 def l_slice(grid_data, coords, logscale = False, dichro = False, title = None, start = 0, cscale = [50, 99]):
     # With the exported intensity grid points and h,k,l list, show l_slices.
     # logscale: show in log color scale.
@@ -255,10 +2080,7 @@ def l_slice(grid_data, coords, logscale = False, dichro = False, title = None, s
     # title: string for figure title
     # start: int, the starting frame number
     # cscale: defalt [50, 99] set color scale corresponding to 50% and 99% intensity level.
-    if logscale:
-        volume = np.log(grid_data)
-    else:
-        volume = grid_data
+    volume, cmap, cmin, cmax = slice_volume(grid_data, logscale, dichro, cscale)
     r, c = len(coords[0]), len(coords[1])
     
     h_min,h_max = [coords[0][0], coords[0][-1]]
@@ -268,16 +2090,6 @@ def l_slice(grid_data, coords, logscale = False, dichro = False, title = None, s
     klen = k_max-k_min
     llen = l_max-l_min
     
-    if dichro:
-        cmap = 'RdBu'
-        cmin, cmax = np.nanpercentile(abs(volume), cscale)
-        cmin = -cmax
-    else:
-        cmin, cmax = np.nanpercentile(volume, cscale)
-        cmap = 'viridis'
-        cmin = 0
-
-
     nb_frames = len(coords[2])
     xx,zz = np.meshgrid(coords[0],coords[1])
     # print(np.shape(xx), np.shape(zz),np.shape(volume[0,1,:]))
@@ -378,10 +2190,7 @@ def k_slice(grid_data, coords, logscale = False, dichro = False, title = None, s
     # title: string for figure title
     # start: int, the starting frame number
     # cscale: defalt [50, 99] set color scale corresponding to 50% and 99% intensity level.
-    if logscale:
-        volume = np.log(grid_data)
-    else:
-        volume = grid_data
+    volume, cmap, cmin, cmax = slice_volume(grid_data, logscale, dichro, cscale)
     r, c = len(coords[0]), len(coords[2])
     
     h_min,h_max = [coords[0][0], coords[0][-1]]
@@ -391,16 +2200,6 @@ def k_slice(grid_data, coords, logscale = False, dichro = False, title = None, s
     klen = k_max-k_min
     llen = l_max-l_min
 
-    if dichro:
-        cmap = 'RdBu'
-        cmin, cmax = np.nanpercentile(abs(volume), cscale)
-        cmin = -cmax
-    else:
-        cmin, cmax = np.nanpercentile(volume, cscale)
-        cmap = 'viridis'
-        cmin = 0
-
-
     nb_frames = len(coords[1])
     xx,zz = np.meshgrid(coords[0],coords[2])
     # print(np.shape(xx), np.shape(zz),np.shape(volume[:,0,:]))
@@ -500,10 +2299,7 @@ def h_slice(grid_data, coords, logscale = False, dichro = False, title = None, s
     # title: string for figure title
     # start: int, the starting frame number
     # cscale: defalt [50, 99] set color scale corresponding to 50% and 99% intensity level.
-    if logscale:
-        volume = np.log(grid_data)
-    else:
-        volume = grid_data
+    volume, cmap, cmin, cmax = slice_volume(grid_data, logscale, dichro, cscale)
     r, c = len(coords[1]), len(coords[2])
     
     h_min,h_max = [coords[0][0], coords[0][-1]]
@@ -513,15 +2309,6 @@ def h_slice(grid_data, coords, logscale = False, dichro = False, title = None, s
     klen = k_max-k_min
     llen = l_max-l_min
     
-    if dichro:
-        cmap = 'RdBu'
-        cmin, cmax = np.nanpercentile(abs(volume), cscale)
-        cmin = -cmax
-    else:
-        cmin, cmax = np.nanpercentile(volume, cscale)
-        cmap = 'viridis'
-        cmin = 0
-
     nb_frames = len(coords[0])
     xx,zz = np.meshgrid(coords[1],coords[2])
     # print(np.shape(xx), np.shape(zz),np.shape(volume[0,1,:]))
@@ -614,9 +2401,152 @@ def h_slice(grid_data, coords, logscale = False, dichro = False, title = None, s
     fig.show()
     return None
 
+class VolumeSlices:
+    # Reads single slices of a map without loading all of it. The source can be a NumPy array or
+    # np.memmap, an h5py dataset, a SparseGrid, the path of a .npy file (opened memory-mapped), an
+    # RSMStore or the path of its .h5 file, whose slices are normalized from the sum and count
+    # volumes when they are read. An .h5 path is opened read-only and closed by close() or at the end
+    # of a with block, a store passed in stays open.
+    # coords: h,k,l axes of the map, only needed for arrays and .npy files
+    def __init__(self, source, coords = None):
+        self.opened = None
+        if isinstance(source, str):
+            if source.endswith('.npy'):
+                source = np.load(source, mmap_mode='r')
+            else:
+                source = self.opened = RSMStore(source, mode='r')
+        self.store = source if isinstance(source, RSMStore) else None
+        if self.store is not None and coords is None:
+            coords = self.store.coords
+        if coords is None:
+            raise ValueError('The h,k,l coords are needed for a ' + type(source).__name__ + ' volume.')
+        self.volume = source
+        self.shape = source.shape
+        self.coords = [np.asarray(c) for c in coords]
+
+    def slice(self, axis, index):
+        # the 2D slice at index along axis (0, 1, 2 for h, k, l)
+        key = [slice(None)] * 3
+        key[axis] = int(index)
+        key = tuple(key)
+        if self.store is not None:
+            return normalize_grid(self.store.f['sum'][key], self.store.f['count'][key], 'numpy')
+        return np.asarray(self.volume[key], dtype=float)
+
+    def sample(self, axis, n = 16):
+        # up to n evenly spaced slices along axis, stacked along it
+        index = np.unique(np.linspace(0, self.shape[axis] - 1, n).round().astype(int))
+        return np.stack([self.slice(axis, i) for i in index], axis)
+
+    def close(self):
+        # closes the .h5 file opened from a path
+        if self.opened is not None:
+            self.opened.close()
+            self.opened = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class SliceViewer:
+    # Slice viewer for large maps. Unlike h_slice, k_slice and l_slice, which put every slice with its
+    # coordinates into the figure, the volume stays in a VolumeSlices source and only the slice at the
+    # slider position is read and pushed to a FigureWidget, so memory and startup time do not depend
+    # on the number of slices. The in-plane coordinates are sent once, a slider move only sends the
+    # slice colors and its position along the axis.
+    # The color scale is set from up to 16 evenly spaced slices (see slice_volume for the options).
+    # An .h5 path stays open while the viewer is used, close() or a with block closes it.
+    # axis: 'h', 'k' or 'l'
+    def __init__(self, source, coords = None, axis = 'l', logscale = False, dichro = False, title = None,
+                 cscale = [50, 99]):
+        self.volume = VolumeSlices(source, coords)
+        self.axis = 'hkl'.index(axis)
+        self.logscale = logscale
+        self.title = title
+        try:
+            _, self.cmap, self.cmin, self.cmax = slice_volume(self.volume.sample(self.axis), logscale, dichro,
+                                                              cscale)
+        except Exception:
+            self.volume.close()
+            raise
+        self.plane = [i for i in range(3) if i != self.axis]
+        coords = self.volume.coords
+        self.grid = np.meshgrid(coords[self.plane[0]], coords[self.plane[1]], indexing='ij')
+
+    def surface(self, index):
+        # the properties of the Surface trace that change with the slice: its colors and position
+        surfacecolor = self.volume.slice(self.axis, index)
+        if self.logscale:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                surfacecolor = np.log(surfacecolor)
+        level = np.full(surfacecolor.shape, self.volume.coords[self.axis][index])
+        return {'xyz'[self.axis]: level, 'surfacecolor': surfacecolor}
+
+    def figure(self, start = 0):
+        # a FigureWidget showing the slice start
+        coords = self.volume.coords
+        trace = dict(self.surface(start), colorscale=self.cmap, cmin=self.cmin, cmax=self.cmax,
+                     colorbar=dict(thickness=20, ticklen=4))
+        trace['xyz'[self.plane[0]]] = self.grid[0]
+        trace['xyz'[self.plane[1]]] = self.grid[1]
+        axis_ranges = [[c[0] - abs(c[-1] - c[0]) * 0.05, c[-1] + abs(c[-1] - c[0]) * 0.05] for c in coords]
+        fig = go.FigureWidget(data=[go.Surface(**trace)])
+        fig.update_layout(
+            title=self.title,
+            width=600,
+            height=600,
+            scene=dict(
+                xaxis=dict(range=axis_ranges[0], autorange=False),
+                yaxis=dict(range=axis_ranges[1], autorange=False),
+                zaxis=dict(range=axis_ranges[2], autorange=False),
+                aspectratio=dict(x=1, y=1, z=1),
+                xaxis_title='H',
+                yaxis_title='K',
+                zaxis_title='L'
+            )
+        )
+        return fig
+
+    def widget(self, start = 0):
+        # the figure with a slider below it, for display in Jupyter
+        try:
+            import ipywidgets
+        except ImportError:
+            raise ImportError('SliceViewer needs ipywidgets (and anywidget for plotly >= 6).')
+        fig = self.figure(start)
+        slider = ipywidgets.IntSlider(value=start, min=0, max=self.volume.shape[self.axis] - 1,
+                                      description='hkl'[self.axis], continuous_update=False)
+
+        def update(change):
+            with fig.batch_update():
+                fig.data[0].update(self.surface(change['new']))
+
+        slider.observe(update, names='value')
+        return ipywidgets.VBox([fig, slider])
+
+    def close(self):
+        # closes the .h5 file opened from a path, the widget can not read slices afterwards
+        self.volume.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def slice_viewer(source, coords = None, axis = 'l', logscale = False, dichro = False, title = None,
+                 start = 0, cscale = [50, 99]):
+    # Shows the slices of a large map along axis ('h', 'k' or 'l') on demand, see SliceViewer.
+    # source: map array, np.memmap, .npy path, h5py dataset, SparseGrid, RSMStore or its .h5 path
+    # e.g. np.save('map.npy', grid_data); slice_viewer('map.npy', coords, 'l', logscale = True)
+    # The widget keeps an .h5 path open read-only, use SliceViewer to close it when done.
+    return SliceViewer(source, coords, axis, logscale, dichro, title, cscale).widget(start)
+
 def make_gif(frame_folder):
     # create gif from pictures in the folder
-    frames = [Image.open(image) for image in glob.glob(f"{frame_folder}*.png")]
+    frames = [Image.open(image) for image in sorted(glob.glob(f"{frame_folder}*.png"))]
     frame_one = frames[0]
     frame_one.save(frame_folder+".gif", format="GIF", append_images=frames,
                save_all=True, duration=100, loop=0)
@@ -624,200 +2554,192 @@ def make_gif(frame_folder):
     print('Gif created in '+ path +'/'+ frame_folder+".gif")
     return None
 
-def k_slice_gif(grid_data, coords, file_name, 
-                logscale = False, dichro = False, cscale = [50, 99], start = 0, title = ''):
-    # With the exported intensity grid points and h,k,l list, show l_slices.
-    # logscale: show in log color scale.
-    # dichro: whether this is a dichroic signal, if yes, the color scale is from (-cmax, +cmax)
-    # title: string for figure title
-    # start: int, the starting frame number
-    # cscale: defalt [50, 99] set color scale corresponding to 50% and 99% intensity level.
+def colormap_lut(cmap, n = 256):
+    # (n, 3) uint8 RGB table of a Plotly colorscale, e.g. 'viridis' or 'RdBu'
+    colors = plotly.colors.sample_colorscale(plotly.colors.get_colorscale(cmap), np.linspace(0, 1, n))
+    return np.array([plotly.colors.unlabel_rgb(color) for color in colors]).round().astype(np.uint8)
+
+# palette of the slice images: the colormap, then the background (NaN voxels) and the text color
+SLICE_COLORS = 254
+SLICE_BACKGROUND = 254
+SLICE_TEXT = 255
+
+def slice_image(data, cmin, cmax, lut, scale = 1, title = '', label = ''):
+    # A palette image of a 2D slice, the first axis horizontal and the second upwards, magnified
+    # scale times, with the title and label above and a color bar from cmin to cmax below.
+    # lut: SLICE_COLORS colors of the colormap (see colormap_lut)
+    with np.errstate(invalid='ignore'):
+        index = np.clip((data - cmin) / (cmax - cmin), 0, 1) * (SLICE_COLORS - 1)
+    index = np.where(np.isnan(index), SLICE_BACKGROUND, np.rint(np.nan_to_num(index))).astype(np.uint8)
+    index = np.repeat(np.repeat(index.T[::-1], scale, axis=0), scale, axis=1)
+
+    height, width = index.shape
+    top, bar, bottom = 30, 10, 16
+    canvas = np.full((top + height + 4 + bar + bottom, max(width, 160)), SLICE_BACKGROUND, dtype=np.uint8)
+    x0 = (canvas.shape[1] - width) // 2
+    canvas[top:top + height, x0:x0 + width] = index
+    canvas[top + height + 4:top + height + 4 + bar, x0:x0 + width] = np.linspace(0, SLICE_COLORS - 1, width).round()
+
+    im = Image.fromarray(canvas, mode='P')
+    im.putpalette(np.concatenate([lut, [[255, 255, 255], [0, 0, 0]]]).astype(np.uint8).tobytes())
+    draw = ImageDraw.Draw(im)
+    draw.text((x0, 2), title, fill=SLICE_TEXT)
+    draw.text((x0, 15), label, fill=SLICE_TEXT)
+    draw.text((x0, top + height + 4 + bar + 2), '{:.3g}'.format(cmin), fill=SLICE_TEXT)
+    cmax_text = '{:.3g}'.format(cmax)
+    draw.text((x0 + width - 6 * len(cmax_text), top + height + 4 + bar + 2), cmax_text, fill=SLICE_TEXT)
+    return im
+
+def plotly_slice_figure(volume, coords, axis, k, cmap, cmin, cmax, title = ''):
+    # the 3D Plotly figure of the slice k along axis (0, 1, 2 for h, k, l), as drawn by the slice viewers
+    plane = [i for i in range(3) if i != axis]
+    grid = np.meshgrid(coords[plane[0]], coords[plane[1]], indexing='ij')
+    key = [slice(None)] * 3
+    key[axis] = k
+    surfacecolor = volume[tuple(key)]
+    trace = {'xyz'[axis]: np.full(surfacecolor.shape, coords[axis][k]),
+             'xyz'[plane[0]]: grid[0], 'xyz'[plane[1]]: grid[1]}
+    fig = go.Figure(go.Surface(surfacecolor=surfacecolor, colorscale=cmap, cmin=cmin, cmax=cmax, **trace))
+    ranges = [[c[0] - abs(c[-1] - c[0]) * 0.05, c[-1] + abs(c[-1] - c[0]) * 0.05] for c in coords]
+    fig.update_layout(
+             title=title,
+             width=600,
+             height=600,
+             scene=dict(
+                        xaxis=dict(range=ranges[0], autorange=False),
+                        yaxis=dict(range=ranges[1], autorange=False),
+                        zaxis=dict(range=ranges[2], autorange=False),
+                        aspectratio=dict(x=1, y=1, z=1),
+                        xaxis_title='H',
+                        yaxis_title='K',
+                        zaxis_title='L'
+                        )
+    )
+    return fig
 
-    if logscale:
-        volume = np.log(grid_data)
+def save_frames(frames, path, duration = 100):
+    # Writes PIL images as an animation, GIF, APNG (.png) or MP4 (with imageio) by the extension of path.
+    # duration: display time of every frame in ms
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.gif':
+        frames[0].save(path, format='GIF', append_images=frames[1:], save_all=True, duration=duration, loop=0)
+    elif ext in ('.png', '.apng'):
+        frames[0].save(path, format='PNG', append_images=frames[1:], save_all=True, duration=duration, loop=0)
+    elif ext == '.mp4':
+        try:
+            import imageio.v3 as iio
+        except ImportError:
+            raise ImportError('MP4 export needs imageio with imageio-ffmpeg.')
+        # video encoders need even frame sizes
+        rgb = [np.asarray(frame.convert('RGB')) for frame in frames]
+        rgb = np.stack([a[:a.shape[0] // 2 * 2, :a.shape[1] // 2 * 2] for a in rgb])
+        iio.imwrite(path, rgb, fps=1000 / duration)
     else:
-        volume = grid_data
-    r, c = len(coords[0]), len(coords[2])
-    
-    h_min,h_max = [coords[0][0], coords[0][-1]]
-    k_min,k_max = [coords[1][0], coords[1][-1]]
-    l_min,l_max = [coords[2][0], coords[2][-1]]
-    hlen = h_max-h_min
-    klen = k_max-k_min
-    llen = l_max-l_min
-    
-    
-    if dichro:
-        cmap = 'RdBu'
-        cmin, cmax = np.nanpercentile(abs(volume), cscale)
-        cmin = -cmax
+        raise ValueError('Unknown animation format ' + repr(ext) + ", use '.gif', '.png' (APNG) or '.mp4'")
+    return path
+
+def slice_gif(grid_data, coords, file_name, axis = 'l', logscale = False, dichro = False, cscale = [50, 99],
+              start = 0, title = '', fmt = 'gif', duration = 100, scale = None, n_workers = None,
+              use_plotly = False):
+    # Animation of the slices of a map along axis ('h', 'k' or 'l'), written to image_export/<file_name>.<fmt>.
+    # The slices are mapped to colors with the color scale of the slice viewers (logscale, dichro,
+    # cscale, see slice_volume) and rendered in parallel into in-memory palette images, no
+    # temporary files are written.
+    # start: first slice of the animation
+    # fmt: 'gif', 'png' (APNG) or 'mp4' (needs imageio)
+    # duration: display time of every frame in ms
+    # scale: integer magnification of the voxels, by default up to about 400 pixels
+    # n_workers: number of rendering threads
+    # use_plotly: render the 3D Plotly figures of the slice viewers instead (needs kaleido, much slower)
+    a = 'hkl'.index(axis)
+    volume, cmap, cmin, cmax = slice_volume(grid_data, logscale, dichro, cscale)
+    indices = range(start, len(coords[a]))
+
+    if use_plotly:
+        frames = [Image.open(io.BytesIO(plotly_slice_figure(volume, coords, a, k, cmap, cmin, cmax, title)
+                                        .to_image(format='png'))) for k in indices]
     else:
-        cmin, cmax = np.nanpercentile(volume, cscale)
-        cmap = 'viridis'
-        cmin = 0
+        plane = [len(coords[i]) for i in range(3) if i != a]
+        scale = scale or max(1, 400 // max(plane))
+        lut = colormap_lut(cmap, SLICE_COLORS)
 
+        def render(k):
+            key = [slice(None)] * 3
+            key[a] = k
+            return slice_image(np.asarray(volume[tuple(key)]), cmin, cmax, lut, scale, title,
+                               'HKL'[a] + ' = {:.4f}'.format(coords[a][k]))
 
-    nb_frames = len(coords[1])
-    xx,zz = np.meshgrid(coords[0],coords[2])
-    
-    def plot(k):
-        fig = go.Figure()
-        fig.add_trace(go.Surface(
-            y=(k_min + k/len(coords[1]) * klen) * np.ones((r, c)),
-            surfacecolor=(volume[:,k,:]),
-            cmin=cmin, cmax=cmax, 
-            x = xx.T,        z= zz.T
-            )    )
-        # Layout
-        fig.update_layout(
-                 title=title,
-                 width=600,
-                 height=600,
-                 scene=dict(
-                            xaxis=dict(range=[h_min-abs(hlen)*0.05, h_max+abs(hlen)*0.05], autorange=False),
-                            yaxis=dict(range=[k_min-abs(klen)*0.05, k_max+abs(klen)*0.05], autorange=False),
-                            zaxis=dict(range=[l_min-abs(llen)*0.05, l_max+abs(llen)*0.05], autorange=False),
-                            aspectratio=dict(x=1, y=1, z=1),
-                            xaxis_title='H',
-                            yaxis_title='K',
-                            zaxis_title='L'
-                            )
-        )
-        return fig
+        with ThreadPoolExecutor(max_workers=n_workers) as pool:
+            frames = list(pool.map(render, indices))
 
-    for ii in range(len(coords[1])):
-        frame = plot(ii)
-        frame.write_image("image_export\\"+file_name+'_'+str(ii).zfill(2)+".png")
+    os.makedirs('image_export', exist_ok=True)
+    path = save_frames(frames, os.path.join('image_export', file_name + '.' + fmt), duration)
+    print('Animation created in ' + os.path.abspath(path))
+    return path
 
-    make_gif('image_export/'+file_name)
-    
-    return None
+def k_slice_gif(grid_data, coords, file_name, 
+                logscale = False, dichro = False, cscale = [50, 99], start = 0, title = '', **kwargs):
+    # With the exported intensity grid points and h,k,l list, write an animation of the k slices.
+    # logscale: show in log color scale.
+    # dichro: whether this is a dichroic signal, if yes, the color scale is from (-cmax, +cmax)
+    # title: string for figure title
+    # start: int, the starting frame number
+    # cscale: defalt [50, 99] set color scale corresponding to 50% and 99% intensity level.
+    # kwargs: fmt, duration, scale, n_workers, use_plotly, see slice_gif
+    return slice_gif(grid_data, coords, file_name, 'k', logscale, dichro, cscale, start, title, **kwargs)
 
 def h_slice_gif(grid_data, coords, file_name, 
-                logscale = False, dichro = False, cscale = [50, 99], start = 0, title = ''):
-
-    if logscale:
-        volume = np.log(grid_data)
-    else:
-        volume = grid_data
-    r, c = len(coords[1]), len(coords[2])
-    
-    h_min,h_max = [coords[0][0], coords[0][-1]]
-    k_min,k_max = [coords[1][0], coords[1][-1]]
-    l_min,l_max = [coords[2][0], coords[2][-1]]
-    hlen = h_max-h_min
-    klen = k_max-k_min
-    llen = l_max-l_min
-    
-    if dichro:
-        cmap = 'RdBu'
-        cmin, cmax = np.nanpercentile(abs(volume), cscale)
-        cmin = -cmax
-    else:
-        cmin, cmax = np.nanpercentile(volume, cscale)
-        cmap = 'viridis'
-        cmin = 0
-
-    nb_frames = len(coords[0])
-    xx,zz = np.meshgrid(coords[1],coords[2])
-    
-    def plot(k):
-        fig = go.Figure()
-        fig.add_trace(go.Surface(
-            x=(h_min + k/len(coords[0]) * hlen) * np.ones((r, c)),
-            surfacecolor=(volume[k,:,:]),
-            cmin=cmin, cmax=cmax, 
-            y = xx.T,        z= zz.T
-            )    )
-        # Layout
-        fig.update_layout(
-                 title=title,
-                 width=600,
-                 height=600,
-                 scene=dict(
-                            xaxis=dict(range=[h_min-abs(hlen)*0.05, h_max+abs(hlen)*0.05], autorange=False),
-                            yaxis=dict(range=[k_min-abs(klen)*0.05, k_max+abs(klen)*0.05], autorange=False),
-                            zaxis=dict(range=[l_min-abs(llen)*0.05, l_max+abs(llen)*0.05], autorange=False),
-                            aspectratio=dict(x=1, y=1, z=1),
-                            xaxis_title='H',
-                            yaxis_title='K',
-                            zaxis_title='L'
-                            )
-        )
-        return fig
-
-    for ii in range(len(coords[0])):
-        frame = plot(ii)
-        frame.write_image("image_export\\"+file_name+'_'+str(ii).zfill(2)+".png")
-
-    make_gif('image_export/'+file_name)
-    
-    return None
+                logscale = False, dichro = False, cscale = [50, 99], start = 0, title = '', **kwargs):
+    # animation of the h slices, see k_slice_gif
+    return slice_gif(grid_data, coords, file_name, 'h', logscale, dichro, cscale, start, title, **kwargs)
 
 def l_slice_gif(grid_data, coords, file_name, 
-                logscale = False, dichro = False, cscale = [50, 99], start = 0, title = ''):
+                logscale = False, dichro = False, cscale = [50, 99], start = 0, title = '', **kwargs):
+    # animation of the l slices, see k_slice_gif
+    return slice_gif(grid_data, coords, file_name, 'l', logscale, dichro, cscale, start, title, **kwargs)
 
-    if logscale:
-        volume = np.log(grid_data)
-    else:
-        volume = grid_data
-    r, c = len(coords[0]), len(coords[1])
-    
-    h_min,h_max = [coords[0][0], coords[0][-1]]
-    k_min,k_max = [coords[1][0], coords[1][-1]]
-    l_min,l_max = [coords[2][0], coords[2][-1]]
-    hlen = h_max-h_min
-    klen = k_max-k_min
-    llen = l_max-l_min
-    
-    if dichro:
-        cmap = 'RdBu'
-        cmin, cmax = np.nanpercentile(abs(volume), cscale)
-        cmin = -cmax
-    else:
-        cmin, cmax = np.nanpercentile(volume, cscale)
-        cmap = 'viridis'
-        cmin = 0
 
-    nb_frames = len(coords[2])
-    xx,zz = np.meshgrid(coords[0],coords[1])
-    
-    def plot(k):
-        fig = go.Figure()
-        fig.add_trace(go.Surface(
-            z=(l_min + k/len(coords[2]) * llen) * np.ones((r, c)),
-            surfacecolor=(volume[:,:,k]),
-            cmin=cmin, cmax=cmax, 
-            x = xx.T,        y= zz.T
-            )    )
-        # Layout
-        fig.update_layout(
-                 title=title,
-                 width=600,
-                 height=600,
-                 scene=dict(
-                            xaxis=dict(range=[h_min-abs(hlen)*0.05, h_max+abs(hlen)*0.05], autorange=False),
-                            yaxis=dict(range=[k_min-abs(klen)*0.05, k_max+abs(klen)*0.05], autorange=False),
-                            zaxis=dict(range=[l_min-abs(llen)*0.05, l_max+abs(llen)*0.05], autorange=False),
-                            aspectratio=dict(x=1, y=1, z=1),
-                            xaxis_title='H',
-                            yaxis_title='K',
-                            zaxis_title='L'
-                            )
-        )
-        return fig
-
-    for ii in range(len(coords[2])):
-        frame = plot(ii)
-        frame.write_image("image_export\\"+file_name+'_'+str(ii).zfill(2)+".png")
-
-    make_gif('image_export/'+file_name)
-    
-    return None
+def vtk_extent_string(extent):
+    return ' '.join(str(int(e)) for e in extent)
 
+def write_vti(block, extent, origin, spacing, file_name, compress = True, dtype = None):
+    # Writes the (nx, ny, nz) block at the index extent (x0, x1, y0, y1, z0, z1) of a grid as a .vti
+    # file in appended binary, zlib compressed if compress. The block is copied once, cast to dtype
+    # (default its own) and reordered to x-fastest order in the same pass.
+    data_array = numpy_support.numpy_to_vtk(np.ascontiguousarray(block.transpose(2, 1, 0), dtype=dtype).reshape(-1),
+                                            deep=False)
+    data_array.SetName('intensity')
+    image_data = vtk.vtkImageData()
+    image_data.SetOrigin(*origin)
+    image_data.SetSpacing(*spacing)
+    image_data.SetExtent(*extent)
+    image_data.GetPointData().SetScalars(data_array)
 
-def save_vtk(array: np.ndarray, coords, path) -> str:
-    """Converts and saves numpy array to VTK image data."""
+    writer = vtk.vtkXMLImageDataWriter()
+    writer.SetFileName(file_name)
+    writer.SetInputData(image_data)
+    writer.SetDataModeToAppended()
+    writer.EncodeAppendedDataOff()
+    writer.SetHeaderTypeToUInt64()
+    if compress:
+        writer.SetCompressorTypeToZLib()
+    else:
+        writer.SetCompressorTypeToNone()
+    writer.Write()
+    return file_name
+
+def save_vtk(array: np.ndarray, coords, path, dtype = None, compress = True, pieces = 1,
+             max_memory = None) -> str:
+    """Converts and saves numpy array (or SparseGrid) to VTK image data.
+
+    The volume is written as vtk_export/<path>.vti in zlib compressed appended binary. With pieces > 1
+    (or a max_memory in bytes for the copy of one piece) it is split along l into pieces written one
+    after the other to vtk_export/<path>_<i>.vti and put together by vtk_export/<path>.pvti, which
+    ParaView and load_vtk open as one volume, so that only one piece is ever copied.
+    dtype: data type of the file, e.g. np.float32 to halve the size, by default that of the array
+    compress: zlib compression of the data
+    Returns the path of the .vti or .pvti file.
+    """
 
     directory_name = 'vtk_export'
     try:
@@ -826,33 +2748,62 @@ def save_vtk(array: np.ndarray, coords, path) -> str:
     except FileExistsError:
         pass
 
-    data_array = numpy_support.numpy_to_vtk(array.flatten(order="F"))
-    image_data = vtk.vtkImageData()
-
-    qx_0, qy_0, qz_0 = coords[0][0], coords[1][0], coords[2][0]
-    del_qx = coords[0][1] - coords[0][0]
-    del_qy = coords[1][1] - coords[1][0]
-    del_qz = coords[2][1] - coords[2][0]
-
-    image_data.SetOrigin(qx_0, qy_0, qz_0)
-    image_data.SetSpacing(del_qx, del_qy, del_qz)
-    image_data.SetDimensions(*array.shape)
-
-    image_data.GetPointData().SetScalars(data_array)
-
-    writer = vtk.vtkXMLImageDataWriter()
-    writer.SetFileName("vtk_export\\" + path + '.vti')
-    writer.SetInputData(image_data)
-    writer.Write()
+    if isinstance(array, SparseGrid):
+        # only the bounding box of the allocated blocks is exported
+        array, coords = array.crop(coords)
+        if array.size == 0:
+            raise ValueError('The sparse grid has no data to export.')
+
+    dtype = np.dtype(dtype or array.dtype)
+    nx, ny, nz = array.shape
+    origin = [c[0] for c in coords]
+    spacing = [c[1] - c[0] if len(c) > 1 else 1. for c in coords]
+    if max_memory is not None:
+        pieces = max(pieces, -(-nx * ny * nz * dtype.itemsize // int(max_memory)))
+    pieces = max(1, min(int(pieces), nz))
+
+    if pieces == 1:
+        return write_vti(array, (0, nx - 1, 0, ny - 1, 0, nz - 1), origin, spacing,
+                         os.path.join(directory_name, path + '.vti'), compress, dtype)
+
+    # adjacent pieces share their boundary plane, as in the piece files written by VTK
+    bounds = np.linspace(0, nz - 1, pieces + 1).round().astype(int)
+    piece_lines = []
+    for i in range(pieces):
+        extent = (0, nx - 1, 0, ny - 1, bounds[i], bounds[i + 1])
+        piece_name = path + '_' + str(i) + '.vti'
+        write_vti(array[:, :, bounds[i]:bounds[i + 1] + 1], extent, origin, spacing,
+                  os.path.join(directory_name, piece_name), compress, dtype)
+        piece_lines.append('    <Piece Extent="' + vtk_extent_string(extent) + '" Source="'
+                           + os.path.basename(piece_name) + '"/>')
+
+    vtk_type = numpy_support.get_vtk_array_type(dtype)
+    type_name = {vtk.VTK_FLOAT: 'Float32', vtk.VTK_DOUBLE: 'Float64', vtk.VTK_INT: 'Int32',
+                 vtk.VTK_LONG_LONG: 'Int64', vtk.VTK_LONG: 'Int64', vtk.VTK_UNSIGNED_INT: 'UInt32'}[vtk_type]
+    lines = ['<?xml version="1.0"?>',
+             '<VTKFile type="PImageData" version="1.0" byte_order="LittleEndian" header_type="UInt64">',
+             '  <PImageData WholeExtent="' + vtk_extent_string((0, nx - 1, 0, ny - 1, 0, nz - 1))
+             + '" GhostLevel="0" Origin="' + ' '.join(repr(float(o)) for o in origin)
+             + '" Spacing="' + ' '.join(repr(float(d)) for d in spacing) + '">',
+             '    <PPointData Scalars="intensity">',
+             '      <PDataArray type="' + type_name + '" Name="intensity"/>',
+             '    </PPointData>'] + piece_lines + ['  </PImageData>', '</VTKFile>']
+    file_name = os.path.join(directory_name, path + '.pvti')
+    with open(file_name, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return file_name
     
-def load_vtk(path):
+def load_vtk(path, extent = None):
     """
-    Reads a VTK image data (.vti) file and converts it back to a numpy array with coordinate information.
+    Reads a VTK image data (.vti or .pvti) file and converts it back to a numpy array with coordinate information.
     
     Parameters:
     -----------
     path : str
-        Path to the .vti file
+        Path to the .vti or .pvti file
+    extent : sequence of 6 int, optional
+        Index extent (x0, x1, y0, y1, z0, z1) to read, bounds included as in VTK. Only the data of
+        this sub-volume is read (for .pvti, only the pieces that overlap it).
         
     Returns:
     --------
@@ -862,18 +2813,25 @@ def load_vtk(path):
         - coords is a list of three numpy arrays representing x, y, z coordinates
     """
     # Create a reader for XML image data files
-    reader = vtk.vtkXMLImageDataWriter()
-    reader = vtk.vtkXMLImageDataReader()
+    if path.endswith('.pvti'):
+        reader = vtk.vtkXMLPImageDataReader()
+    else:
+        reader = vtk.vtkXMLImageDataReader()
     reader.SetFileName(path)
-    reader.Update()
+    if extent is None:
+        reader.Update()
+    else:
+        reader.UpdateInformation()
+        whole = reader.GetOutputInformation(0).Get(vtk.vtkStreamingDemandDrivenPipeline.WHOLE_EXTENT())
+        extent = [min(max(int(e), whole[2 * (i // 2)]), whole[2 * (i // 2) + 1]) for i, e in enumerate(extent)]
+        reader.UpdateExtent(extent)
     
     # Get the image data
     image_data = reader.GetOutput()
     
-    # Get the dimensions of the data
+    # Get the extent of the data read, origin and spacing
+    data_extent = image_data.GetExtent()
     dims = image_data.GetDimensions()
-    
-    # Get origin and spacing
     origin = image_data.GetOrigin()
     spacing = image_data.GetSpacing()
     
@@ -886,11 +2844,14 @@ def load_vtk(path):
     array = numpy_data.reshape(dims, order='F')
     
     # Reconstruct the coordinate arrays
-    x_coords = np.array([origin[0] + i * spacing[0] for i in range(dims[0])])
-    y_coords = np.array([origin[1] + i * spacing[1] for i in range(dims[1])])
-    z_coords = np.array([origin[2] + i * spacing[2] for i in range(dims[2])])
-    
-    coords = [x_coords, y_coords, z_coords]
+    coords = [origin[i] + spacing[i] * np.arange(data_extent[2 * i], data_extent[2 * i + 1] + 1) for i in range(3)]
+
+    if extent is not None:
+        # the reader may return whole pieces, keep the requested extent only
+        key = tuple(slice(extent[2 * i] - data_extent[2 * i], extent[2 * i + 1] - data_extent[2 * i] + 1)
+                    for i in range(3))
+        array = array[key]
+        coords = [c[k] for c, k in zip(coords, key)]
     
     return array, coords
 
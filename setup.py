@@ -33,6 +33,7 @@ setup(
         "pandas", 
         "plotly",
         "pillow",
+        "h5py",
         "pyevtk",
         "vtk",
     ],
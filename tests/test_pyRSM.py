@@ -0,0 +1,50 @@
+# Checks of pyRSM on the bundled scans in data/ (scan 14 has 61 frames).
+# usage: python -m pytest tests
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import pyRSM
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'data')
+
+@pytest.mark.parametrize('converter', ['xu', 'numpy'])
+def test_single_frame_chunk(converter):
+    # a budget of 60 frames per chunk leaves the 61st frame of scan 14 in a chunk of its own
+    frames = pyRSM.load_scan(DATA, 14)['length']
+    max_memory = (frames - 1) * 516 * 516 * pyRSM.BYTES_PER_PIXEL
+    assert len(pyRSM.chunk_frames(frames, max_memory)[-1]) == 1
+    grid_data, _ = pyRSM.rsm_convert(DATA, [14], 20, 20, 20, gridder = 'numpy', converter = converter)
+    chunked, _ = pyRSM.rsm_convert(DATA, [14], 20, 20, 20, gridder = 'numpy', converter = converter,
+                                   max_memory = max_memory)
+    np.testing.assert_allclose(chunked, grid_data, rtol = 1e-10)
+
+def test_octree_resample_matches_fine_grid():
+    # A depth-1 tree with every base voxel split holds the map of a grid with twice the resolution,
+    # whose voxels are centred on the centres of the tree's children.
+    hklrange = [[-0.3, 0.7], [1.1, 1.9], [2.5, 4.0]]
+    shape = (5, 6, 7)
+    rng = np.random.default_rng(0)
+    x, y, z = [rng.uniform(lo, hi, 20000) for lo, hi in hklrange]
+    data = rng.uniform(1, 2, 20000)
+    tree = pyRSM.OctreeGrid(hklrange, *shape, max_depth = 1, min_count = 0, min_intensity = 0)
+    tree(x, y, z, data)
+    tree.refine()
+    tree(x, y, z, data)
+    tree.finish()
+    grid_data, coords = tree.resample()
+
+    g = pyRSM.NumpyGridder3D(*[2 * n for n in shape])
+    margin = [pyRSM.xu.gridder.delta(lo, hi, n) / 4 for (lo, hi), n in zip(hklrange, shape)]
+    g.dataRange(*[a for (lo, hi), m in zip(hklrange, margin) for a in (lo - m, hi + m)])
+    g(x, y, z, data)
+    # the outermost fine voxels lie outside hklrange and are left out of the resampled map
+    inner = (slice(1, -1),) * 3
+    assert grid_data.shape == g.data[inner].shape
+    for c, axis in zip(coords, [g.xaxis, g.yaxis, g.zaxis]):
+        np.testing.assert_allclose(c, axis[1:-1])
+    np.testing.assert_allclose(grid_data, g.data[inner], rtol = 1e-12)